@@ -16,7 +16,6 @@ import argparse
 import counterraptor as cr
 import vanilla
 import json
-import pickle
 import relays
 
 
@@ -27,8 +26,10 @@ client_to_guard_res = json.load(open("cg_resilience.json"))
 client_as_lst = list(client_to_guard_res.keys())
 
 ip_to_as = json.load(open("../guard_info/ip_to_as.json"))
-guard_to_bw = pickle.load(open("../guard_info/guard_to_bw.pickle", "rb"))
-guard_to_cost = {guard: relays.get_cost(bw) for guard, bw in guard_to_bw.items()}
+guard_to_bw = relays.load_guard_to_bw("../guard_info/guard_to_bw.pickle")
+bw_model = relays.get_guard_bw_model(guard_to_bw, "../guard_info/bw_model_table.json")
+guard_to_cost = relays.get_cost_dict(guard_to_bw, bw_model)
+guard_cost_total = sum(guard_to_cost.values())
 
 alpha = 0.5
 sample_size = int(0.1*len(guard_to_bw))     # g = 0.1
@@ -308,8 +309,8 @@ def disp_targeted_split_table(client_as, bw_resource, num_relays_lst):
                                                         alpha,
                                                         sample_size)
 
-        cost = num_relays * relays.get_cost(bw_resource / num_relays)
-        tot_cost = sum(guard_to_cost.values()) + cost
+        cost = num_relays * relays.get_cost(bw_resource / num_relays, bw_model)
+        tot_cost = guard_cost_total + cost
         rel_cost = cost / tot_cost
 
         print(f"{num_relays} | relCost: {rel_cost} | VT prob: {v_prob} | targ CR prob: {mal_prob} | AS{best_as}")
@@ -343,8 +344,8 @@ def disp_untargeted_split_table_avg(client_as_lst,
             sum_probs += mal_guard_prob
         mal_prob = sum_probs / len(client_as_lst)
 
-        cost = num_relays * relays.get_cost(bw_resource / num_relays)
-        tot_cost = sum(guard_to_cost.values()) + cost
+        cost = num_relays * relays.get_cost(bw_resource / num_relays, bw_model)
+        tot_cost = guard_cost_total + cost
         rel_cost = cost / tot_cost
 
         print(f"{num_relays} | relCost: {rel_cost} | VT prob: {v_prob} | utarg CR prob: {mal_prob} | AS{best_as_untargeted}")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+cymru_standin.py
+
+Local stand-in for the Team Cymru bulk whois interface, answering
+begin/noasname/<IPs>/end sessions with 'AS | IP' rows from a CAIDA
+pfx2as file, so that gen_relay_info --cymru can be run offline.
+
+    python cymru_standin.py routeviews-rv2-20180801-1200.pfx2as.gz --port 4343
+    python gen_relay_info.py <ns_filename> --cymru --cymru_host 127.0.0.1 --cymru_port 4343
+"""
+
+import argparse
+import asyncio
+import datetime
+import pfx2as
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pfx2as_filename")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4343)
+    parser.add_argument("--drop_after", type=int, default=None,
+                        help="close each connection after answering this many "
+                        "IPs, to exercise client retries")
+    return parser.parse_args()
+
+async def handle_bulk_session(reader, writer, lookup, drop_after=None):
+    """
+    Answers one bulk session, writing a row for each IP as soon as it is
+    read. lookup maps an IP to its AS or None.
+    """
+    num_answered = 0
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            query = line.decode('utf-8', 'replace').strip()
+            if query == "begin":
+                writer.write(("Bulk mode; whois.cymru.com [%s]\n" %
+                    datetime.datetime.now(datetime.timezone.utc).strftime(
+                        "%Y-%m-%d %H:%M:%S +0000")).encode('ascii'))
+            elif query == "end":
+                break
+            elif query in ("noasname", "verbose", ""):
+                continue
+            else:
+                if (drop_after is not None) and (num_answered >= drop_after):
+                    break
+                asn = lookup(query)
+                writer.write(("%-8s| %s\n" % ("NA" if asn is None else asn,
+                    query)).encode('ascii'))
+                num_answered += 1
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_standin(lookup, host="127.0.0.1", port=0, drop_after=None):
+    """Returns asyncio server answering bulk sessions from lookup."""
+    return await asyncio.start_server(
+        lambda reader, writer: handle_bulk_session(reader, writer, lookup,
+                                                   drop_after),
+        host, port)
+
+def main(args):
+    table = pfx2as.load_pfx2as(args.pfx2as_filename)
+
+    def lookup(ip):
+        return table.lookup([ip])[0]
+
+    async def serve():
+        server = await start_standin(lookup, args.host, args.port,
+                                     args.drop_after)
+        print("Serving on %s:%d" % (args.host, args.port))
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main(parse_args())
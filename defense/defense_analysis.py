@@ -44,12 +44,13 @@ pfi_instance.verify()
 ip_to_as = json.load(open("../guard_info/ip_to_as.json"))
 all_ases = [asn.strip() for asn in open("../data/relay_ases.txt", 'r').readlines()]
 
-guard_to_bw = pickle.load(open("../guard_info/guard_to_bw.pickle", "rb"))
+guard_to_bw = relays.load_guard_to_bw("../guard_info/guard_to_bw.pickle")
+bw_model = relays.get_guard_bw_model(guard_to_bw, "../guard_info/bw_model_table.json")
 
 fp_to_bw = {g.fingerprint: bw for (g, bw) in guard_to_bw.items()}
 fp_to_as = {g.fingerprint: ip_to_as[g.address] for (g, bw) in guard_to_bw.items()}
 fp_to_coord = pickle.load(open("../guard_info/guard_fps_to_coord.pickle", "rb"))
-fp_to_cost = {fp: relays.get_cost(bw) for fp, bw in fp_to_bw.items()}
+fp_to_cost = relays.get_cost_dict(fp_to_bw, bw_model)
 
 
 def parse_args():
@@ -82,7 +83,7 @@ def counterraptor_init_ratios(client_as, fp_to_bw, fp_to_as, fp_to_cost):
                                 sample_size)
 
     for fp, prob in distr.items():
-        cost = relays.get_cost(fp_to_bw[fp])
+        cost = fp_to_cost[fp]
         ratio = prob * total_cost / cost
         ratios[fp] = ratio
 
@@ -104,7 +105,7 @@ def denasa_init_ratios(client_as, fp_to_bw, fp_to_as, fp_to_cost):
                                                 pfi_instance)
 
     for fp, prob in distr.items():
-        cost = relays.get_cost(fp_to_bw[fp])
+        cost = fp_to_cost[fp]
         ratio = prob * total_cost / cost
         ratios[fp] = ratio
 
@@ -124,7 +125,7 @@ def lastor_init_ratios(client_coord, fp_to_bw, fp_to_coord, fp_to_cost):
                                               fp_to_coord)
 
     for fp, prob in distr.items():
-        cost = relays.get_cost(fp_to_bw[fp])
+        cost = fp_to_cost[fp]
         ratio = prob * total_cost / cost
         ratios[fp] = ratio
 
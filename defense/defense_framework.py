@@ -43,12 +43,13 @@ pfi_instance.verify()
 ip_to_as = json.load(open("../guard_info/ip_to_as.json"))
 all_ases = [asn.strip() for asn in open("../data/relay_ases.txt", 'r').readlines()]
 
-guard_to_bw = pickle.load(open("../guard_info/guard_to_bw.pickle", "rb"))
+guard_to_bw = relays.load_guard_to_bw("../guard_info/guard_to_bw.pickle")
+bw_model = relays.get_guard_bw_model(guard_to_bw, "../guard_info/bw_model_table.json")
 
 fp_to_bw = {g.fingerprint: bw for (g, bw) in guard_to_bw.items()}
 fp_to_as = {g.fingerprint: ip_to_as[g.address] for (g, bw) in guard_to_bw.items()}
 fp_to_coord = pickle.load(open("../guard_info/guard_fps_to_coord.pickle", "rb"))
-fp_to_cost = {fp: relays.get_cost(bw) for fp, bw in fp_to_bw.items()}
+fp_to_cost = relays.get_cost_dict(fp_to_bw, bw_model)
 
 
 def parse_args():
@@ -72,9 +73,8 @@ def counterraptor_redistr(client_as, fp_to_bw, fp_to_as, threshold):
     alpha = 0.5
     sample_g = 0.1
    
-    total_cost = 0
-    for fp, bw in fp_to_bw.items():
-        total_cost += relays.get_cost(bw)
+    fp_to_cost = relays.get_cost_dict(fp_to_bw, bw_model)
+    total_cost = sum(fp_to_cost.values())
     
     thresh = threshold / total_cost
 
@@ -107,7 +107,7 @@ def counterraptor_redistr(client_as, fp_to_bw, fp_to_as, threshold):
         num_over = 0
         excess = 0
         for fp in list(curr_fps):
-            cost = relays.get_cost(fp_to_bw[fp])
+            cost = fp_to_cost[fp]
             ratio = curr_distr[fp] / cost * norm
             ratios[fp] += ratio
 
@@ -122,7 +122,7 @@ def counterraptor_redistr(client_as, fp_to_bw, fp_to_as, threshold):
 
     redistr = {}
     for fp, val in ratios.items():
-        prob = val * relays.get_cost(fp_to_bw[fp])
+        prob = val * fp_to_cost[fp]
         redistr[fp] = prob
 
     return redistr
@@ -139,9 +139,8 @@ def denasa_redistr(client_as, fp_to_bw, fp_to_as, threshold):
         print("Error: threshold must be at least 1.")
         return None
 
-    total_cost = 0
-    for fp, bw in fp_to_bw.items():
-        total_cost += relays.get_cost(bw)
+    fp_to_cost = relays.get_cost_dict(fp_to_bw, bw_model)
+    total_cost = sum(fp_to_cost.values())
     
     thresh = threshold / total_cost
 
@@ -172,7 +171,7 @@ def denasa_redistr(client_as, fp_to_bw, fp_to_as, threshold):
         num_over = 0
         excess = 0
         for fp in list(curr_fps):
-            cost = relays.get_cost(fp_to_bw[fp])
+            cost = fp_to_cost[fp]
             ratio = curr_distr[fp] / cost * norm
             ratios[fp] += ratio
 
@@ -187,7 +186,7 @@ def denasa_redistr(client_as, fp_to_bw, fp_to_as, threshold):
 
     redistr = {}
     for fp, val in ratios.items():
-        prob = val * relays.get_cost(fp_to_bw[fp])
+        prob = val * fp_to_cost[fp]
         redistr[fp] = prob
 
     return redistr
@@ -204,9 +203,8 @@ def lastor_redistr(client_coord, fp_to_bw, fp_to_coord, threshold):
         print("Error: threshold must be at least 1.")
         return None
 
-    total_cost = 0
-    for fp, bw in fp_to_bw.items():
-        total_cost += relays.get_cost(bw)
+    fp_to_cost = relays.get_cost_dict(fp_to_bw, bw_model)
+    total_cost = sum(fp_to_cost.values())
     
     thresh = threshold / total_cost
 
@@ -233,7 +231,7 @@ def lastor_redistr(client_coord, fp_to_bw, fp_to_coord, threshold):
         num_over = 0
         excess = 0
         for fp in list(curr_fps):
-            cost = relays.get_cost(fp_to_bw[fp])
+            cost = fp_to_cost[fp]
             ratio = curr_distr[fp] / cost * norm
             ratios[fp] += ratio
 
@@ -248,7 +246,7 @@ def lastor_redistr(client_coord, fp_to_bw, fp_to_coord, threshold):
 
     redistr = {}
     for fp, val in ratios.items():
-        prob = val * relays.get_cost(fp_to_bw[fp])
+        prob = val * fp_to_cost[fp]
         redistr[fp] = prob
 
     return redistr
@@ -4,10 +4,14 @@ make_usability_table.py
 Author: Gerry Wan
 """
 
+import sys
+
+sys.path.append('..')
+
 import denasa
 import pfi
 import json
-import pickle
+import relays
 
 def main():
     """
@@ -18,7 +22,7 @@ def main():
     libspookyhash_filename = "./libspookyhash.so"
 
     ip_to_as = json.load(open("../guard_info/ip_to_as.json"))
-    guard_to_bw = pickle.load(open("../guard_info/guard_to_bw.pickle", "rb"))
+    guard_to_bw = relays.load_guard_to_bw("../guard_info/guard_to_bw.pickle")
     fp_to_as = {g.fingerprint: ip_to_as[g.address] for (g, bw) in guard_to_bw.items()}
 
     pfi_instance = pfi.PFI(libspookyhash_filename,
@@ -17,7 +17,6 @@ import denasa
 import pfi
 import vanilla
 import json
-import pickle
 import operator
 import relays
 
@@ -27,8 +26,10 @@ libspookyhash_filename = "./libspookyhash.so"
 
 ip_to_as = json.load(open("../guard_info/ip_to_as.json"))
 all_ases = [asn.strip() for asn in open("../data/relay_ases.txt", 'r').readlines()]
-guard_to_bw = pickle.load(open("../guard_info/guard_to_bw.pickle", "rb"))
-guard_to_cost = {guard: relays.get_cost(bw) for guard, bw in guard_to_bw.items()}
+guard_to_bw = relays.load_guard_to_bw("../guard_info/guard_to_bw.pickle")
+bw_model = relays.get_guard_bw_model(guard_to_bw, "../guard_info/bw_model_table.json")
+guard_to_cost = relays.get_cost_dict(guard_to_bw, bw_model)
+guard_cost_total = sum(guard_to_cost.values())
 
 pfi_instance = pfi.PFI(libspookyhash_filename,
                 paths_filename,
@@ -203,8 +204,8 @@ def disp_untargeted_split_table_avg(client_as_lst, bw_resource, num_relays_lst):
         avg_prob = res_triple[0]
         hi_prob = res_triple[2]  # tuple of (client AS, prob)
 
-        cost = num_relays * relays.get_cost(bw_resource / num_relays)
-        tot_cost = sum(guard_to_cost.values()) + cost
+        cost = num_relays * relays.get_cost(bw_resource / num_relays, bw_model)
+        tot_cost = guard_cost_total + cost
         rel_cost = cost / tot_cost
 
         print(f"{num_relays} | relCost: {rel_cost} | VT prob: {v_prob} | avg prob: {avg_prob} | max prob: {hi_prob}")
@@ -218,7 +219,8 @@ def disp_max_advantages(client_as_lst, bw_resources_lst, best_as_dict):
     for i in range(0, len(bw_resources_lst)):
         bw_resource = bw_resources_lst[i]
         v_guard_probs, v_prob = vanilla.compute_vanilla_guard_distr(guard_to_bw, bw_resource)
-        rel_cost = relays.get_cost(bw_resource) / (relays.get_cost(bw_resource)+sum(guard_to_cost.values()))
+        cost = relays.get_cost(bw_resource, bw_model)
+        rel_cost = cost / (cost + guard_cost_total)
 
         best_as_untargeted = best_as_dict[str(bw_resource)]
         untargeted_prob_triple = untargeted_prob(client_as_lst, 
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+gen_network_snapshot.py
+
+Converts fat network state files into columnar snapshots that
+relays.load_network_state_snapshot can memory-map.
+"""
+
+import argparse
+import relays
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ns_filenames", nargs='+')
+    parser.add_argument("--suffix", default=".snapshot",
+                        help="appended to each network state filename")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes used to parse descriptors")
+    return parser.parse_args()
+
+def main(args):
+
+    for ns_filename in args.ns_filenames:
+        print("Reading in network state: %s" % ns_filename)
+        network_state = relays.tempest_fat_network_state(ns_filename,
+                                                         workers=args.workers)
+
+        snapshot_filename = ns_filename + args.suffix
+        relays.write_network_state_snapshot(network_state, snapshot_filename)
+        print("Wrote to %s" % snapshot_filename)
+
+
+if __name__ == "__main__":
+    main(parse_args())
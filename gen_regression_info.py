@@ -6,34 +6,43 @@ Author: Gerry Wan
 """
 
 import argparse
+import datetime
 import json
-import pickle
+import sys
+import numpy as np
 import relays
 from scipy import stats 
 
-ip_to_as = json.load(open("guard_info/ip_to_as.json"))  
-guard_to_bw = pickle.load(open("guard_info/guard_to_bw.pickle", "rb"))
-guard_fp_to_bw = {g.fingerprint: bw for (g, bw) in guard_to_bw.items()}
+# strftime formats grouping consensuses into model periods
+PERIOD_FORMATS = {'hour': '%Y-%m-%d-%H', 'day': '%Y-%m-%d', 'month': '%Y-%m'}
 
 def parse_args():
     parser = argparse.ArgumentParser()
+    parser.add_argument("--ns_dir", default=None,
+                        help="fit one model per period over every network "
+                        "state in this directory")
+    parser.add_argument("--period", default="month",
+                        choices=sorted(PERIOD_FORMATS))
+    parser.add_argument("--prefetch", type=int, default=2,
+                        help="network states decoded ahead of the current one")
+    parser.add_argument("--out", default="guard_info/bw_model_table.json")
     return parser.parse_args()
 
-def get_guard_to_real(ns_filename):
+def get_guard_to_real(ns_filename, guard_fp_to_bw):
     """
     Returns a dict mapping guard fingerprint to *observed*
     bandwidth (in Bytes/second)
     """
 
-    ns = relays.tempest_fat_network_state(ns_filename)
+    # only guard descriptors are parsed
+    ns = relays.tempest_fat_network_state(ns_filename, lazy=True)
     cons_rel_stats = ns.cons_rel_stats
     descriptors = ns.descriptors
 
-    fp_to_real = {}
-    for fp, relay in descriptors.items():
-        fp_to_real[fp] = min(relay.average_bandwidth, relay.observed_bandwidth)
-
-    guard_fp_to_real = {fp: fp_to_real[fp] for fp in guard_fp_to_bw}
+    guard_fp_to_real = {}
+    for fp in guard_fp_to_bw:
+        relay = descriptors[fp]
+        guard_fp_to_real[fp] = min(relay.average_bandwidth, relay.observed_bandwidth)
 
     return guard_fp_to_real
 
@@ -69,9 +78,166 @@ def get_lin_reg(guard_fp_to_bw, guard_fp_to_real):
     print(f'r squared: {r_value**2}')
 
 
+class OnlineLinearRegression:
+    """
+    Least-squares fit of y on x accumulated batch by batch. Only the
+    count, means and co-moments are kept (batches are merged with the
+    pairwise update of Chan et al.), so memory does not grow with the
+    number of points.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.m_xx = 0.0
+        self.m_yy = 0.0
+        self.m_xy = 0.0
+
+    def update(self, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        n_b = len(x)
+        if (n_b == 0):
+            return
+
+        mean_xb = x.mean()
+        mean_yb = y.mean()
+        dx = x - mean_xb
+        dy = y - mean_yb
+
+        n = self.n + n_b
+        delta_x = mean_xb - self.mean_x
+        delta_y = mean_yb - self.mean_y
+        scale = self.n * n_b / n
+        self.m_xx += dx @ dx + delta_x * delta_x * scale
+        self.m_yy += dy @ dy + delta_y * delta_y * scale
+        self.m_xy += dx @ dy + delta_x * delta_y * scale
+        self.mean_x += delta_x * n_b / n
+        self.mean_y += delta_y * n_b / n
+        self.n = n
+
+    def fit(self):
+        """
+        Returns (slope, intercept, r squared). Raises ValueError if the
+        slope is undefined: fewer than two points, or all x identical.
+        """
+        # co-moment of identical x is zero up to rounding of the means
+        if (self.n < 2) or (self.m_xx <= 1e-15 * self.n * self.mean_x**2):
+            raise ValueError(f"slope undefined (n={self.n}, no spread in x)")
+        slope = self.m_xy / self.m_xx
+        intercept = self.mean_y - slope * self.mean_x
+        # as scipy.stats.linregress, constant y gives r = 0
+        if (self.m_yy <= 0):
+            r_squared = 0.0
+        else:
+            r_squared = self.m_xy**2 / (self.m_xx * self.m_yy)
+        return slope, intercept, r_squared
+
+
+def get_weight_real_pairs(network_state):
+    """
+    Returns numpy arrays of guard bandwidth weights and real bandwidths
+    (B/s, the smaller of average and observed) for the guards in
+    network_state with nonzero weight.
+
+    Unlike the guard_to_bw.pickle population that DEFAULT_BW_MODEL was
+    fit over, these guards are not filtered by gen_relay_info's CAIDA
+    (IP to AS) and MaxMind (GeoIP) checks: those need lookups for every
+    guard address of every network state. The per-period models are
+    therefore fit over all weighted guards.
+    """
+
+    fingerprints, guard_mask, position_weights = \
+        relays.get_network_weights(network_state, positions=('g',))
+    weights = position_weights['g']
+    keep = weights > 0
+
+    columns = network_state.relay_columns
+    if (columns is not None) and ('observed_bandwidth' in columns):
+        real = np.minimum(columns['average_bandwidth'],
+                          columns['observed_bandwidth'])[keep]
+    else:
+        descriptors = network_state.descriptors
+        real = np.array([min(descriptors[fp].average_bandwidth,
+                             descriptors[fp].observed_bandwidth)
+                         for fp in fingerprints[keep].tolist()], dtype=np.float64)
+
+    return weights[keep], real
+
+
+def stream_lin_reg(ns_dir, period, prefetch):
+    """
+    Fits real bandwidth on guard bandwidth weight for every period of the
+    network states in ns_dir in one pass, holding at most prefetch + 1
+    network states at a time. Returns list of per-period model dicts
+    (see relays.BandwidthModelTable) and the OnlineLinearRegression over
+    all periods.
+    """
+
+    period_format = PERIOD_FORMATS[period]
+    period_to_reg = {}
+    period_to_start = {}
+    overall = OnlineLinearRegression()
+
+    for ns_filename, ns in relays.iter_network_states(ns_dir,
+                                                      prefetch=prefetch,
+                                                      lazy=True):
+        valid_after = ns.cons_valid_after
+        key = datetime.datetime.fromtimestamp(valid_after,
+            datetime.timezone.utc).strftime(period_format)
+        if key not in period_to_reg:
+            period_to_reg[key] = OnlineLinearRegression()
+            period_to_start[key] = valid_after
+
+        x, y = get_weight_real_pairs(ns)
+        period_to_reg[key].update(x, y)
+        overall.update(x, y)
+        print(f"{ns_filename}: {len(x)} guards")
+
+    periods = []
+    for key, reg in period_to_reg.items():
+        # periods without a fit are left out, so the previous period's
+        # model covers them (see relays.BandwidthModelTable)
+        try:
+            slope, intercept, r_squared = reg.fit()
+        except ValueError as e:
+            print(f"Skipping period {key}: {e}")
+            continue
+        periods.append({'period': key, 'start': period_to_start[key],
+                        'slope': slope, 'intercept': intercept,
+                        'r_squared': r_squared, 'n': reg.n})
+
+    return periods, overall
+
+
 def main(args):
+    if args.ns_dir is not None:
+        periods, overall = stream_lin_reg(args.ns_dir, args.period,
+                                          args.prefetch)
+        if not periods:
+            # an empty table would only fail later, in the analysis scripts
+            sys.exit(f"No bandwidth model could be fit from the network "
+                     f"states in {args.ns_dir} ({overall.n} guards)")
+        slope, intercept, r_squared = overall.fit()
+        for p in periods:
+            print(f"{p['period']} | n: {p['n']} | slope: {p['slope']} | "
+                  f"intercept: {p['intercept']} | r squared: {p['r_squared']}")
+        print("=== all periods ===")
+        print(f'slope: {slope}')
+        print(f'intercept: {intercept}')
+        print(f'r squared: {r_squared}')
+
+        with open(args.out, 'w') as f:
+            json.dump(periods, f, indent=1)
+        print("Wrote to %s" % args.out)
+        return
+
+    guard_to_bw = relays.load_guard_to_bw("guard_info/guard_to_bw.pickle")
+    guard_fp_to_bw = {g.fingerprint: bw for (g, bw) in guard_to_bw.items()}
+
     ns_filename = "data/2018-08-01-07-00-00-network_state"
-    guard_fp_to_real = get_guard_to_real(ns_filename)
+    guard_fp_to_real = get_guard_to_real(ns_filename, guard_fp_to_bw)
     get_lin_reg(guard_fp_to_bw, guard_fp_to_real)
 
 if __name__ == "__main__":
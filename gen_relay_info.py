@@ -7,18 +7,42 @@ Functions to generate relay and guard data
 """
 
 import argparse
+import asyncio
 import relays
+import pfx2as
 import json
 import pickle
 import geopy.distance
-import geoip2.database
+import geolocation
 
-geoip_path = 'GeoLite2-City.mmdb'
+geoip_path = geolocation.GEOIP_PATH
+
+CYMRU_HOST = 'whois.cymru.com'
+CYMRU_PORT = 43
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("ns_filename")
-    return parser.parse_args()
+    parser.add_argument("--prev_ns_filename", default=None,
+                        help="network state that guard_info was last generated "
+                        "from; if given, only changed guards are looked up")
+    parser.add_argument("--pfx2as", default=None,
+                        help="CAIDA pfx2as file; if given, IPs are mapped to "
+                        "ASes from it instead of Team-Cymru lookups")
+    parser.add_argument("--cymru", action='store_true',
+                        help="query the Team-Cymru bulk interface directly "
+                        "instead of writing IP files for a manual lookup")
+    parser.add_argument("--cymru_host", default=CYMRU_HOST)
+    parser.add_argument("--cymru_port", type=int, default=CYMRU_PORT)
+    args = parser.parse_args()
+    if (args.prev_ns_filename is not None) and \
+       ((args.pfx2as is not None) or args.cymru):
+        # data/relay_ases.txt needs every relay IP mapped, and only guard
+        # mappings are kept between runs
+        parser.error("--prev_ns_filename cannot be combined with --pfx2as "
+                     "or --cymru, which map every relay IP; run without "
+                     "--prev_ns_filename instead")
+    return args
 
 def list_guard_ips(network_state):
     """ 
@@ -46,26 +70,56 @@ def list_guard_ips(network_state):
     file.close()
     print("Wrote to %s" % guard_ips_outfile)
 
+def list_new_guard_ips(guard_list, ip_to_as):
+    """
+    generates text file that lists only the guard IP addresses
+    missing from ip_to_as, for incremental Team-Cymru IP to AS mapping
+    """
+    guard_ips_outfile = "guard_info/guard_ips.txt"
+
+    new_ips = sorted({guard.address for guard in guard_list
+                      if guard.address not in ip_to_as})
+    print("Number of new guard IPs: %d" % len(new_ips))
+
+    file = open(guard_ips_outfile, 'w')
+    file.write("begin\n")
+    file.write("noasname\n")
+
+    for ip in new_ips:
+        file.write(ip)
+        file.write('\n')
+    file.write("end\n")
+
+    file.close()
+    print("Wrote to %s" % guard_ips_outfile)
+
 def list_relay_ips(network_state):
     """ 
     generates text file that lists relay IP addresses for
     use in Team-Cymru IP to AS mapping
     """
-    relay_ips_outfile = "data/relay_ips.txt"
-
     cons_rel_stats = network_state.cons_rel_stats
     descriptors = network_state.descriptors
 
     relay_list = relays.get_relay_list(cons_rel_stats)
     print("Number of relays: %d" % len(relay_list))
 
+    write_relay_ips([relay.address for relay in relay_list])
+
+def write_relay_ips(relay_ips):
+    """
+    writes relay_ips to data/relay_ips.txt in Team-Cymru bulk format,
+    which the analysis scripts also read the relay IPs from
+    """
+    relay_ips_outfile = "data/relay_ips.txt"
+
     # relay IPs for IP-AS mapping
     file = open(relay_ips_outfile, 'w')
     file.write("begin\n")
     file.write("noasname\n")
 
-    for relay in relay_list:
-        file.write(relay.address)
+    for ip in relay_ips:
+        file.write(ip)
         file.write('\n')
     file.write("end\n")
 
@@ -108,6 +162,47 @@ def list_guard_ases():
     file.close()
     print("Wrote to %s" % guard_ases_outfile)
 
+def update_guard_ases(guard_list, ip_to_as):
+    """
+    Takes Team-Cymru AS to IP mapping file for the new guard IPs
+    (see list_new_guard_ips) as input.
+
+    adds its mappings to ip_to_as, then regenerates the guard AS list
+    and ip_to_as json. Returns the updated ip_to_as.
+    """
+    infile = open("data/cymru_as_to_ip_guards", 'r')
+    guard_ases_outfile = "guard_info/guard_ases.txt"
+
+    for line in infile:
+        if '|' in line and 'NA' not in line:
+            info = line.split('|')
+            asn = info[0].strip()
+            ip = info[1].strip()
+            if not asn.isdigit():
+                # 'AS | IP' column header
+                continue
+
+            ip_to_as[ip] = asn
+    infile.close()
+
+    ases = {ip_to_as[guard.address] for guard in guard_list
+            if guard.address in ip_to_as}
+    print("Num unique IPs: %d" % len(ip_to_as))
+    print("Num ASes: %d" % len(ases))
+
+    with open("guard_info/ip_to_as.json", 'w+') as file:
+        json.dump(ip_to_as, file)
+    print("Wrote to %s" % "guard_info/ip_to_as.json")
+
+    file = open(guard_ases_outfile, 'w')
+    for asn in ases:
+        file.write(asn)
+        file.write('\n')
+    file.close()
+    print("Wrote to %s" % guard_ases_outfile)
+
+    return ip_to_as
+
 def list_relay_ases():
     """ 
     Takes Team-Cymru AS to IP mapping file as input.
@@ -137,10 +232,190 @@ def list_relay_ases():
     file.close()
     print("Wrote to %s" % list_of_ases_outfile)
 
+def parse_cymru_row(line):
+    """
+    Returns (AS, IP) for an 'AS | IP' row of a Team-Cymru bulk reply, with
+    AS None for unmapped ('NA') IPs, or None for other lines.
+    """
+    if '|' not in line:
+        return None
+    info = line.split('|')
+    asn = info[0].strip()
+    ip = info[1].strip()
+    if asn == 'AS':
+        # column header
+        return None
+    return (None if asn == 'NA' else asn), ip
+
+async def cymru_session(queue, ip_to_as, host, port, window, timeout):
+    """
+    Runs one Team-Cymru bulk session: streams chunks of IPs from queue over
+    a single connection, keeping at most window IPs unanswered, while
+    parsing the rows as they arrive, until the queue is empty. Returns list
+    of (unanswered IPs, attempt) for the chunks in flight if the
+    connection fails.
+    """
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port), timeout)
+    unanswered = {}
+    answered = asyncio.Event()
+
+    async def send():
+        writer.write(b"begin\nnoasname\n")
+        while not queue.empty():
+            while len(unanswered) >= window:
+                answered.clear()
+                await answered.wait()
+            if queue.empty():
+                break
+            chunk, attempt = queue.get_nowait()
+            for ip in chunk:
+                unanswered[ip] = attempt
+            writer.write("".join(ip + "\n" for ip in chunk).encode('ascii'))
+            await writer.drain()
+        writer.write(b"end\n")
+        await writer.drain()
+
+    sender = asyncio.ensure_future(send())
+    try:
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if not line:
+                break
+            row = parse_cymru_row(line.decode('utf-8', 'replace'))
+            if row is None:
+                continue
+            asn, ip = row
+            if (unanswered.pop(ip, None) is not None) and (asn is not None):
+                ip_to_as[ip] = asn
+            answered.set()
+        # the server closed the connection; a sender still waiting for
+        # answers is cancelled below and its IPs retried
+        if sender.done():
+            await sender
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        sender.cancel()
+        writer.close()
+
+    failed = {}
+    for ip, attempt in unanswered.items():
+        failed.setdefault(attempt, []).append(ip)
+    return [(ips, attempt) for attempt, ips in failed.items()]
+
+async def cymru_bulk_lookup(ips, host=CYMRU_HOST, port=CYMRU_PORT,
+                            chunk_size=1000, connections=2, retries=3,
+                            timeout=60):
+    """
+    Maps ips to ASes with the Team-Cymru bulk whois protocol. Chunks of
+    chunk_size IPs are pipelined over up to connections reused connections,
+    each keeping two chunks in flight, and rows are parsed as they arrive.
+    IPs left unanswered by a failed connection, and failed connection
+    attempts, are retried up to retries times. Returns dict mapping each
+    mapped IP to its AS.
+    """
+    queue = asyncio.Queue()
+    ips = sorted(set(ips))
+    for i in range(0, len(ips), chunk_size):
+        queue.put_nowait((ips[i:i+chunk_size], 0))
+
+    ip_to_as = {}
+    connect_failures = 0
+    while not queue.empty():
+        sessions = [cymru_session(queue, ip_to_as, host, port,
+                                  2 * chunk_size, timeout)
+                    for i in range(min(connections, queue.qsize()))]
+        for result in await asyncio.gather(*sessions, return_exceptions=True):
+            if isinstance(result, (OSError, asyncio.TimeoutError)):
+                connect_failures += 1
+                if connect_failures > retries:
+                    raise ConnectionError("Cannot connect to %s:%d: %s" %
+                                          (host, port, result))
+                continue
+            elif isinstance(result, Exception):
+                raise result
+            for chunk, attempt in result:
+                if attempt >= retries:
+                    raise ConnectionError("Team-Cymru lookup of %d IPs failed "
+                                          "after %d retries" % (len(chunk),
+                                                                retries))
+                print("Retrying %d IPs" % len(chunk))
+                queue.put_nowait((chunk, attempt + 1))
+        if not queue.empty():
+            await asyncio.sleep(1)
+
+    return ip_to_as
+
+def get_relay_ips(network_state):
+    """Returns sorted list of the distinct relay IPs in network_state."""
+    relay_list = relays.get_relay_list(network_state.cons_rel_stats)
+    return sorted({relay.address for relay in relay_list})
+
+def write_ases(guard_list, relay_ip_to_as):
+    """
+    Takes mapping of relay IP to AS as input.
+
+    generates the guard AS list, relay AS list and json mapping guard
+    IP to AS. Returns the guard ip_to_as.
+    """
+    guard_ases_outfile = "guard_info/guard_ases.txt"
+    relay_ases_outfile = "data/relay_ases.txt"
+
+    guard_ips = {guard.address for guard in guard_list}
+    ip_to_as = {ip: asn for ip, asn in relay_ip_to_as.items()
+                if ip in guard_ips}
+    guard_ases = set(ip_to_as.values())
+    relay_ases = set(relay_ip_to_as.values())
+    print("Num unique IPs: %d" % len(ip_to_as))
+    print("Num ASes: %d" % len(guard_ases))
+    print("Num relay ASes: %d" % len(relay_ases))
+
+    with open("guard_info/ip_to_as.json", 'w+') as file:
+        json.dump(ip_to_as, file)
+    print("Wrote to %s" % "guard_info/ip_to_as.json")
+
+    for ases, outfile in ((guard_ases, guard_ases_outfile),
+                          (relay_ases, relay_ases_outfile)):
+        file = open(outfile, 'w')
+        for asn in ases:
+            file.write(asn)
+            file.write('\n')
+        file.close()
+        print("Wrote to %s" % outfile)
+
+    return ip_to_as
+
+def map_ases_pfx2as(network_state, guard_list, pfx2as_filename):
+    """
+    Maps guard and relay IPs to ASes by longest-prefix match in a CAIDA
+    pfx2as file, in place of the Team-Cymru round trip.
+    """
+    table = pfx2as.load_pfx2as(pfx2as_filename)
+
+    relay_ips = get_relay_ips(network_state)
+    write_relay_ips(relay_ips)
+
+    # guards are a subset of relays, so one batch lookup covers both
+    relay_ip_to_as = table.get_ip_to_as(relay_ips)
+    return write_ases(guard_list, relay_ip_to_as)
+
+def map_ases_cymru(network_state, guard_list, host, port):
+    """
+    Maps guard and relay IPs to ASes with a direct Team-Cymru bulk
+    lookup, in place of writing IP files and reading back the replies.
+    """
+    relay_ips = get_relay_ips(network_state)
+    write_relay_ips(relay_ips)
+    print("Looking up %d relay IPs at %s:%d" % (len(relay_ips), host, port))
+    relay_ip_to_as = asyncio.run(cymru_bulk_lookup(relay_ips, host, port))
+    return write_ases(guard_list, relay_ip_to_as)
+
 def main(args):
 
     print("Reading in network state: %s" % args.ns_filename)
-    network_state = relays.tempest_fat_network_state(args.ns_filename)
+    # only descriptor membership is needed, so skip parsing descriptors
+    network_state = relays.tempest_fat_network_state(args.ns_filename, lazy=True)
 
     cons_rel_stats = network_state.cons_rel_stats
     descriptors = network_state.descriptors
@@ -152,14 +427,71 @@ def main(args):
     guard_list = relays.get_guard_list(cons_rel_stats, descriptors)
     print(f"Num guards with appropriate flags: {len(guard_list)}")
 
-    # outputs text files for Team-Cymru mappings
-    list_guard_ips(network_state)
-    list_relay_ips(network_state)
+    # fingerprints of guards that joined or moved to another address since
+    # the previous network state, and the other guards of the last run,
+    # which keep their IP-AS and GeoIP results
+    changed = set()
+    carried = []
+    if args.prev_ns_filename is not None:
+        print("Reading in previous network state: %s" % args.prev_ns_filename)
+        prev_network_state = relays.tempest_fat_network_state(
+            args.prev_ns_filename, lazy=True)
+        diff = relays.diff_network_states(prev_network_state, network_state)
+        print(f"Relays joined: {len(diff.joined)} | left: {len(diff.left)} | "
+              f"bw changed: {len(diff.bandwidth_changed)} | "
+              f"flags changed: {len(diff.flags_changed)}")
+
+        # IP-AS and GeoIP results only depend on the address, so only
+        # guards that joined or moved need lookups; bandwidth and flag
+        # changes are covered by recomputing the weights below
+        prev_relay_addresses = {
+            fprint: rel_stat.address
+            for fprint, rel_stat in prev_network_state.cons_rel_stats.items()}
+        changed = set(diff.joined.tolist())
+        changed.update(guard.fingerprint for guard in guard_list
+                       if prev_relay_addresses.get(guard.fingerprint,
+                                                   guard.address)
+                       != guard.address)
+        print(f"Guards that moved: {len(changed) - len(diff.joined)}")
+        prev_guard_to_bw = relays.load_guard_to_bw("guard_info/guard_to_bw.pickle")
+        prev_addresses = {guard.fingerprint: guard.address
+                          for guard in prev_guard_to_bw}
+        carried = [guard for guard in guard_list
+                   if (guard.fingerprint not in changed) and
+                   (prev_addresses.get(guard.fingerprint) == guard.address)]
+        print(f"Guards carried over from previous run: {len(carried)}")
+
+    # (fingerprint, IP) of guards already known to pass the GeoIP filter
+    geo_known = {(guard.fingerprint, guard.address) for guard in carried}
+
+    if args.pfx2as is not None:
+        ip_to_as = map_ases_pfx2as(network_state, guard_list, args.pfx2as)
+    elif args.cymru:
+        ip_to_as = map_ases_cymru(network_state, guard_list, args.cymru_host,
+                                  args.cymru_port)
+    elif args.prev_ns_filename is None:
+        # outputs text files for Team-Cymru mappings
+        list_guard_ips(network_state)
+        list_relay_ips(network_state)
+
+        list_guard_ases()
+        list_relay_ases()
+
+        ip_to_as = json.load(open("guard_info/ip_to_as.json"))
+    else:
+        prev_ip_to_as = json.load(open("guard_info/ip_to_as.json"))
+        # IP-AS mappings only depend on the IP, so every unchanged guard
+        # keeps its mapping
+        ip_to_as = {guard.address: prev_ip_to_as[guard.address]
+                    for guard in guard_list
+                    if (guard.fingerprint not in changed) and
+                    (guard.address in prev_ip_to_as)}
+        list_new_guard_ips(guard_list, ip_to_as)
+        list_relay_ips(network_state)
+
+        ip_to_as = update_guard_ases(guard_list, ip_to_as)
+        list_relay_ases()
 
-    list_guard_ases()
-    list_relay_ases()
-
-    ip_to_as = json.load(open("guard_info/ip_to_as.json"))
     print(f"Num unique IPs (one IP can host 2 guards): {len(ip_to_as)}")
 
 
@@ -168,17 +500,12 @@ def main(args):
     print(f"Num guards CAIDA filtered: {len(guard_list)}")
 
     # Filter out guards with IPs not in Maxmind GeoIP database
-    reader = geoip2.database.Reader(geoip_path)
-    guard_list_geofilter = []
-    for guard in guard_list:
-        ip = guard.address
-        response = reader.city(ip)
-        lat = response.location.latitude
-        lon = response.location.longitude
-        if lat is not None and lon is not None:
-            guard_list_geofilter.append(guard)
-
-    guard_list = guard_list_geofilter
+    geo_unknown = [guard.address for guard in guard_list
+                   if (guard.fingerprint, guard.address) not in geo_known]
+    ip_to_coord = geolocation.get_ip_to_coord(geo_unknown, geoip_path)
+    guard_list = [guard for guard in guard_list
+                  if ((guard.fingerprint, guard.address) in geo_known)
+                  or (guard.address in ip_to_coord)]
     print(f"Num guards Maxmind filtered: {len(guard_list)}")
     
     guard_to_bw = relays.get_guard_weights(guard_list, bw_weights, bwweightscale)
@@ -193,6 +520,9 @@ def main(args):
 
 
     
+    # Store compact records so readers do not need stem to unpickle
+    guard_to_bw = relays.get_guard_records(guard_to_bw,
+                                           network_state.cons_valid_after)
     pickle.dump(guard_to_bw, open("guard_info/guard_to_bw.pickle", "wb"))
     print("Wrote to %s" % "guard_info/guard_to_bw.pickle")
     
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+geolocation.py
+
+Shared MaxMind GeoLite2 City lookups. Coordinates are cached in memory
+(LRU) and on disk in an SQLite file next to the mmdb, keyed by the
+database build epoch and IP, so repeated runs against the same database
+build do not resolve an IP twice. An IP with no location is cached too,
+as None in memory and with NULL lat/lon on disk.
+"""
+
+import collections
+import os
+import sqlite3
+
+import geoip2.database
+import geoip2.errors
+
+GEOIP_PATH = 'GeoLite2-City.mmdb'
+
+# IPs per SQLite query, below the default host parameter limit
+QUERY_CHUNK = 500
+
+class GeoResolver:
+    """
+    IP to (lat, lon) resolver over one GeoLite2 City database. IPs that
+    are not in the database, or have no location, resolve to None.
+    """
+
+    def __init__(self, geoip_path=GEOIP_PATH, cache_filename=None,
+                 cache_size=1 << 16):
+        """
+        geoip_path:     GeoLite2 City mmdb file
+        cache_filename: persistent cache, geoip_path + '.cache.sqlite' if
+                        None, no persistent cache if False
+        cache_size:     number of IPs kept in memory
+        """
+        self.geoip_path = geoip_path
+        self.reader = geoip2.database.Reader(geoip_path)
+        self.build_epoch = int(self.reader.metadata().build_epoch)
+        self.cache_size = cache_size
+        self.memory = collections.OrderedDict()
+
+        if (cache_filename is None):
+            cache_filename = geoip_path + '.cache.sqlite'
+        self.cache_filename = cache_filename
+        self.db = None
+        if cache_filename:
+            self.db = sqlite3.connect(cache_filename)
+            self.db.execute("CREATE TABLE IF NOT EXISTS coords ("
+                            "epoch INTEGER NOT NULL, ip TEXT NOT NULL, "
+                            "lat REAL, lon REAL, PRIMARY KEY (epoch, ip)) "
+                            "WITHOUT ROWID")
+            self.db.commit()
+
+    def _remember(self, ip, coord):
+        self.memory[ip] = coord
+        self.memory.move_to_end(ip)
+        if (len(self.memory) > self.cache_size):
+            self.memory.popitem(last=False)
+
+    def _resolve(self, ip):
+        """Returns (lat, lon) of ip from the mmdb, None if unknown."""
+        try:
+            response = self.reader.city(ip)
+        except (geoip2.errors.AddressNotFoundError, ValueError):
+            return None
+        lat = response.location.latitude
+        lon = response.location.longitude
+        if (lat is None) or (lon is None):
+            return None
+        return (float(lat), float(lon))
+
+    def _load(self, ips):
+        """Returns dict of the ips found in the persistent cache."""
+        found = {}
+        for i in range(0, len(ips), QUERY_CHUNK):
+            chunk = ips[i:i + QUERY_CHUNK]
+            rows = self.db.execute(
+                "SELECT ip, lat, lon FROM coords WHERE epoch = ? AND ip IN "
+                "(%s)" % ','.join('?' * len(chunk)),
+                [self.build_epoch] + chunk)
+            for ip, lat, lon in rows:
+                found[ip] = None if (lat is None) else (lat, lon)
+        return found
+
+    def _store(self, ip_to_coord):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO coords VALUES (?, ?, ?, ?)",
+            ((self.build_epoch, ip) + (coord or (None, None))
+             for ip, coord in ip_to_coord.items()))
+        self.db.commit()
+
+    def get_coords(self, ips):
+        """
+        Returns list of (lat, lon) tuples for ips, None where an IP has no
+        location. Each distinct IP is looked up at most once, first in
+        memory, then in the persistent cache, then in the mmdb. Batches
+        with more distinct IPs than cache_size would only evict themselves
+        from memory, so they are left to the persistent cache.
+        """
+        resolved = {}
+        missing = []
+        for ip in dict.fromkeys(ips):
+            if ip in self.memory:
+                self.memory.move_to_end(ip)
+                resolved[ip] = self.memory[ip]
+            else:
+                missing.append(ip)
+
+        if missing and (self.db is not None):
+            loaded = self._load(missing)
+            resolved.update(loaded)
+            missing = [ip for ip in missing if ip not in loaded]
+        else:
+            loaded = {}
+
+        looked_up = {ip: self._resolve(ip) for ip in missing}
+        if looked_up and (self.db is not None):
+            self._store(looked_up)
+        resolved.update(looked_up)
+
+        if (len(resolved) <= self.cache_size):
+            for ip in loaded:
+                self._remember(ip, loaded[ip])
+            for ip in looked_up:
+                self._remember(ip, looked_up[ip])
+
+        return [resolved[ip] for ip in ips]
+
+    def get_coord(self, ip):
+        """Returns (lat, lon) of ip, None if it has no location."""
+        return self.get_coords([ip])[0]
+
+    def get_ip_to_coord(self, ips):
+        """Returns dict mapping each located IP in ips to (lat, lon)."""
+        return {ip: coord for ip, coord in zip(ips, self.get_coords(ips))
+                if coord is not None}
+
+    def close(self):
+        self.reader.close()
+        if (self.db is not None):
+            self.db.close()
+            self.db = None
+
+
+_resolvers = {}
+
+def get_resolver(geoip_path=GEOIP_PATH):
+    """Returns the GeoResolver shared by every caller of geoip_path."""
+    key = os.path.abspath(geoip_path)
+    if key not in _resolvers:
+        _resolvers[key] = GeoResolver(geoip_path)
+    return _resolvers[key]
+
+def get_ip_to_coord(ips, geoip_path=GEOIP_PATH):
+    """Returns dict mapping each located IP in ips to (lat, lon)."""
+    return get_resolver(geoip_path).get_ip_to_coord(ips)
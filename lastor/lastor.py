@@ -6,6 +6,10 @@ Author: Gerry Wan
 
 """
 
+import sys
+
+sys.path.append('..')
+
 import os
 import argparse
 import pickle
@@ -15,10 +19,11 @@ import math
 import operator
 import copy
 import geopy.distance
-import geoip2.database
+import geolocation
+import relays
 
-geoip_path = 'GeoLite2-City.mmdb'
-guard_to_bw = pickle.load(open("../guard_info/guard_to_bw.pickle", "rb"))
+geoip_path = geolocation.GEOIP_PATH
+guard_to_bw = relays.load_guard_to_bw("../guard_info/guard_to_bw.pickle")
 fp_to_bw = {g.fingerprint: bw for (g, bw) in guard_to_bw.items()}
 relay_ips = [ip.strip() for ip in open('../data/relay_ips.txt', 'r').readlines()]
 client_to_all_clusters = json.load(open('../lastor/client_to_all_clusters.json'))
@@ -28,38 +33,21 @@ def get_ip_coord(ips_lst):
     Returns a dict mapping IP address to {lat, lon} tuple.
     """
 
-    reader = geoip2.database.Reader(geoip_path)
-
-    ip_to_coord = {}
-    for ip in ips_lst:
-        response = reader.city(ip)
-        lat = response.location.latitude
-        lon = response.location.longitude
-        if lat is None or lon is None:
-            continue
-        ip_to_coord[ip] = (float(lat), float(lon))
-
-    reader.close()
-    return ip_to_coord
+    return geolocation.get_ip_to_coord(ips_lst, geoip_path)
 
 def get_guard_coord(guard_to_bw):
     """
     Returns a dict mapping guard fingerprint to {lat, lon} tuple.
     """
 
-    reader = geoip2.database.Reader(geoip_path)
+    ip_to_coord = geolocation.get_ip_to_coord(
+        [guard.address for guard in guard_to_bw], geoip_path)
 
     fp_to_coord = {}
-    for guard, bw in guard_to_bw.items():
-        ip = guard.address
-        response = reader.city(ip)
-        lat = response.location.latitude
-        lon = response.location.longitude
-        if lat is None or lon is None:
-            continue
-        fp_to_coord[guard.fingerprint] = (float(lat), float(lon))
-
-    reader.close()
+    for guard in guard_to_bw:
+        if guard.address in ip_to_coord:
+            fp_to_coord[guard.fingerprint] = ip_to_coord[guard.address]
+
     return fp_to_coord
 
 def get_cluster(lat, lon, edge=2):
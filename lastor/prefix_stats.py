@@ -6,6 +6,10 @@ Author: Gerry Wan
 
 """
 
+import sys
+
+sys.path.append('..')
+
 import os
 import argparse
 import pickle
@@ -14,38 +18,29 @@ import re
 import math
 import operator
 import geopy.distance
-import geoip2.database
+import geolocation
+import relays
 
-geoip_path = 'GeoLite2-City.mmdb'
+geoip_path = geolocation.GEOIP_PATH
 
 def get_24prefix_coords(ips_lst):
     """
     Returns a dict mapping IPv4 /24 prefixes to set of lat/lon locations.
     """
-    reader = geoip2.database.Reader(geoip_path)
+    pfxs = list(dict.fromkeys(re.findall('.*\..*\..*\.', ip)[0]
+                              for ip in ips_lst))
+    print(f"Num /24 prefixes: {len(pfxs)}")
+
+    # every address of every prefix, resolved in one batch; batches this
+    # large bypass the in-memory LRU and are served by the SQLite cache
+    test_ips = [pfx + str(i) for pfx in pfxs for i in range(0, 256)]
+    coords = geolocation.get_resolver(geoip_path).get_coords(test_ips)
 
     pfx_coords = {}
-    cnt = 0
-    for ip in ips_lst:
-        pfx = re.findall('.*\..*\..*\.', ip)[0]
-
-        if pfx not in pfx_coords:
-            coords = set()
-        else:
-            coords = pfx_coords[pfx]
-        
-        for i in range(0, 256):
-            test_ip = pfx + str(i)
-            response = reader.city(test_ip)
-            lat = response.location.latitude
-            lon = response.location.longitude
-            coords.add((lat, lon))
-
-        pfx_coords[pfx] = coords
-        cnt += 1
-        print(cnt)
-
-    reader.close()
+    for j, pfx in enumerate(pfxs):
+        pfx_coords[pfx] = {coord or (None, None)
+                           for coord in coords[j * 256:(j + 1) * 256]}
+
     return pfx_coords
 
 def snap_to_corner(lat, lon, edge=2):
@@ -108,7 +103,7 @@ def print_24prefix_stats(pfx_coords, edge=2):
 
 def main():
 
-    guard_to_bw = pickle.load(open("../guard_info/guard_to_bw.pickle", "rb"))
+    guard_to_bw = relays.load_guard_to_bw("../guard_info/guard_to_bw.pickle")
     pfxs = pickle.load(open("pfx_coords.pickle", "rb"))
     print_24prefix_stats(pfxs, 2)
 
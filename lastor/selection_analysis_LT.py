@@ -22,8 +22,10 @@ import operator
 import geopy.distance
 
 
-guard_to_bw = pickle.load(open("../guard_info/guard_to_bw.pickle", "rb"))
-guard_to_cost = {guard: relays.get_cost(bw) for guard, bw in guard_to_bw.items()}
+guard_to_bw = relays.load_guard_to_bw("../guard_info/guard_to_bw.pickle")
+bw_model = relays.get_guard_bw_model(guard_to_bw, "../guard_info/bw_model_table.json")
+guard_to_cost = relays.get_cost_dict(guard_to_bw, bw_model)
+guard_cost_total = sum(guard_to_cost.values())
 relay_ips = [ip.strip() for ip in open('../data/relay_ips.txt', 'r').readlines()]
 
 def make_prob_matrix(client_lst, mal_coord, bw_resources_lst):
@@ -169,11 +171,9 @@ def disp_untargeted_split_table(num_relays, bw_resource):
 
 
     v_distr, v_prob = vanilla.compute_vanilla_guard_distr(guard_to_bw, bw_resource)
+    cost = num_relays * relays.get_cost(bw_resource / num_relays, bw_model)
+    rel_cost = cost / (guard_cost_total + cost)
     for i in range(0, num_relays):    
-        cost = num_relays * relays.get_cost(bw_resource / num_relays)
-        tot_cost = sum(guard_to_cost.values()) + cost
-        rel_cost = cost / tot_cost
-
         res = untargeted_prob(client_lst, mal_coords_lst[:i+1], bw_resource)
         print(f"{i+1} | relCost: {rel_cost} | VT prob: {v_prob} | avg prob: {res[0]} | max prob: {res[2]} |{mal_coords_lst[i]}")
 
@@ -202,11 +202,9 @@ def disp_targeted_split_table(num_relays, bw_resource):
         mal_coords_lst.append((lat, lon))
 
     v_distr, v_prob = vanilla.compute_vanilla_guard_distr(guard_to_bw, bw_resource)
+    cost = num_relays * relays.get_cost(bw_resource / num_relays, bw_model)
+    rel_cost = cost / (guard_cost_total + cost)
     for i in range(0, num_relays): 
-        cost = num_relays * relays.get_cost(bw_resource / num_relays)
-        tot_cost = sum(guard_to_cost.values()) + cost
-        rel_cost = cost / tot_cost
-
         # untargeted with 1 client in client_lst   
         res = untargeted_prob([client_coord], mal_coords_lst[:i+1], bw_resource)
         print(f"{i+1} | relCost: {rel_cost} | VT prob: {v_prob} | targ LT prob: {res[0]} | {mal_coords_lst[i]}")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+pfx2as.py
+
+Offline IP to AS mapping by longest-prefix match over a CAIDA RouteViews
+prefix-to-AS dump (routeviews-rv2-yyyymmdd-hhmm.pfx2as[.gz]), used in
+place of Team Cymru bulk lookups.
+"""
+
+import gzip
+import ipaddress
+
+import numpy as np
+
+def parse_origin(field):
+    """
+    Returns the origin AS of a pfx2as AS field. Multi-origin prefixes
+    (1234_5678) and AS sets (1234,5678) map to their first AS, as the
+    analyses need a single AS per IP.
+    """
+    return field.split('_')[0].split(',')[0]
+
+def ip_to_int_array(ips):
+    """
+    Returns int64 numpy array of IPv4 addresses as integers, -1 for
+    addresses that are not IPv4.
+    """
+    ints = np.full(len(ips), -1, dtype=np.int64)
+    for i, ip in enumerate(ips):
+        try:
+            ints[i] = int(ipaddress.IPv4Address(ip))
+        except ipaddress.AddressValueError:
+            pass
+    return ints
+
+class PrefixTable:
+    """
+    IPv4 prefix to origin AS table. Prefixes are grouped by length into
+    sorted arrays of network addresses, and a lookup tries the lengths from
+    longest to shortest, each with one vectorized binary search, so the
+    longest matching prefix wins.
+    """
+
+    def __init__(self, networks, lengths, origins):
+        """
+        networks: integer network addresses
+        lengths:  prefix lengths
+        origins:  origin AS of each prefix (str)
+        """
+        networks = np.asarray(networks, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        self.asns, codes = np.unique(np.array(origins, dtype=str),
+            return_inverse=True)
+
+        self.tables = []
+        for length in sorted(set(lengths.tolist()), reverse=True):
+            mask = (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+            in_length = lengths == length
+            length_networks = networks[in_length] & mask
+            # the first entry for a prefix wins
+            length_networks, first = np.unique(length_networks,
+                return_index=True)
+            self.tables.append((mask, length_networks,
+                codes[in_length][first]))
+
+    def __len__(self):
+        return sum(len(networks) for mask, networks, codes in self.tables)
+
+    def lookup_codes(self, ints):
+        """
+        Returns int64 numpy array of indices into self.asns for integer
+        IPv4 addresses ints, -1 where no prefix matches.
+        """
+        ints = np.asarray(ints, dtype=np.int64)
+        result = np.full(len(ints), -1, dtype=np.int64)
+        unresolved = ints >= 0
+        for mask, networks, codes in self.tables:
+            if (not unresolved.any()) or (len(networks) == 0):
+                continue
+            masked = ints[unresolved] & mask
+            pos = np.minimum(np.searchsorted(networks, masked),
+                len(networks) - 1)
+            found = networks[pos] == masked
+            rows = np.flatnonzero(unresolved)[found]
+            result[rows] = codes[pos[found]]
+            unresolved[rows] = False
+        return result
+
+    def lookup(self, ips):
+        """Returns list of origin AS (str) for ips, None if not routed."""
+        codes = self.lookup_codes(ip_to_int_array(ips))
+        return [None if code < 0 else str(self.asns[code])
+            for code in codes.tolist()]
+
+    def get_ip_to_as(self, ips):
+        """Returns dict mapping each routed IP in ips to its origin AS."""
+        return {ip: asn for ip, asn in zip(ips, self.lookup(ips))
+            if asn is not None}
+
+def load_pfx2as(filename):
+    """
+    Returns PrefixTable of the IPv4 prefixes in a CAIDA pfx2as file
+    (tab-separated network, prefix length and AS, optionally gzipped).
+    """
+    networks = []
+    lengths = []
+    origins = []
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt') as f:
+        for line in f:
+            fields = line.split()
+            if (len(fields) != 3) or (':' in fields[0]):
+                continue
+            networks.append(int(ipaddress.IPv4Address(fields[0])))
+            lengths.append(int(fields[1]))
+            origins.append(parse_origin(fields[2]))
+    print("Read %d prefixes from %s" % (len(networks), filename))
+    return PrefixTable(networks, lengths, origins)
@@ -1,78 +1,595 @@
 import pathsim
-import stem.descriptor.reader
+from relays import parse_consensus_trusted, parse_descriptors_trusted, \
+    open_network_state, detect_compression
 import stem.descriptor
 import stem
+import functools
+import multiprocessing
 import os
 import os.path
 import pickle
+import random
+import sqlite3
+import tarfile
+import tempfile
+from array import array
+from io import BytesIO
+import numpy as np
+
+class DescriptorTimeline:
+    """Descriptor records of one relay sorted by publication timestamp, so
+    that process_consensus can find them by binary search. timestamps and
+    records are slices of the sorted arrays of a DescriptorIndex."""
+
+    __slots__ = ('timestamps', 'records')
+
+    def __init__(self, timestamps, records):
+        self.timestamps = timestamps
+        self.records = records
+
+    def __getitem__(self, t):
+        i = int(np.searchsorted(self.timestamps, t, 'left'))
+        if (i == len(self.timestamps)) or (self.timestamps[i] != t):
+            raise KeyError(t)
+        return int(self.records[i])
+
+    def items(self):
+        return zip(self.timestamps.tolist(), self.records.tolist())
+
+    def latest(self, after, until):
+        """Returns latest timestamp t with after < t <= until, or 0."""
+        i = int(np.searchsorted(self.timestamps, until, 'right')) - 1
+        if (i >= 0) and (self.timestamps[i] > after) and (self.timestamps[i] > 0):
+            return int(self.timestamps[i])
+        return 0
+
+    def between(self, start, end):
+        """Returns (t, record) for start <= t <= end, sorted by t."""
+        i = int(np.searchsorted(self.timestamps, start, 'left'))
+        j = int(np.searchsorted(self.timestamps, end, 'right'))
+        return list(zip(self.timestamps[i:j].tolist(),
+            self.records[i:j].tolist()))
+
+    def baseline(self, t):
+        """Returns latest timestamp <= t, or the earliest one if there is
+        none (None if there are no descriptors)."""
+        i = int(np.searchsorted(self.timestamps, t, 'right')) - 1
+        if (i >= 0):
+            return int(self.timestamps[i])
+        if len(self.timestamps):
+            return int(self.timestamps[0])
+        return None
+
+class DescriptorIndex:
+    """Server descriptors read by read_descriptors. Instead of parsed
+    descriptors, only (fingerprint, published timestamp, hibernating flag,
+    source file, byte offset, length) is kept per descriptor, in compact
+    arrays, and the text is re-read from the source file for the
+    descriptors written out. index[fp] is the DescriptorTimeline of a
+    relay, whose entries are record numbers into the arrays."""
+
+    def __init__(self):
+        self.fingerprints = []
+        self.fingerprint_ids = {}
+        # file paths, or spool files holding members of compressed archives
+        self.sources = []
+        self.source_names = set()
+        self.type_annotations = []
+        self.fingerprint = array('i')
+        self.published = array('q')
+        self.hibernating = array('b')
+        self.source = array('i')
+        self.offset = array('q')
+        self.length = array('i')
+        self.type_annotation = array('h')
+        self.timelines = {}
+        self._open_source = (None, None)
+
+    def __len__(self):
+        return len(self.published)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.timelines
+
+    def __getitem__(self, fingerprint):
+        return self.timelines[fingerprint]
+
+    def count_relays(self):
+        return len(self.fingerprints)
+
+    def sample_records(self, sample_size, seed=None):
+        """Returns up to sample_size random record numbers."""
+        rng = random.Random(seed)
+        return rng.sample(range(len(self)), min(sample_size, len(self)))
+
+    def has_source(self, name):
+        """Returns True if the file or archive name was already indexed."""
+        return name in self.source_names
+
+    def add_source(self, path, name=None):
+        """Adds file path that descriptors are re-read from, returning its
+        source id. name is the file or archive read (path by default)."""
+        self.sources.append(path)
+        self.source_names.add(path if (name is None) else name)
+        return len(self.sources) - 1
+
+    def add_spool(self, name):
+        """Adds a spool file for the members of compressed archive name,
+        returning (open binary file, source id). The spool is removed when
+        the index is closed."""
+        spool = tempfile.TemporaryFile()
+        self.sources.append(spool)
+        self.source_names.add(name)
+        return spool, len(self.sources) - 1
+
+    def finish_spool(self, spool):
+        """Called once everything has been written to spool."""
+        spool.flush()
+
+    def set_indexed(self, source):
+        """Marks source as completely indexed. Only SqliteDescriptorIndex
+        keeps sources across runs, so this is a no-op here."""
+        pass
+
+    def add(self, fingerprint, published, hibernating, source, offset,
+        length, type_annotation):
+        """Appends a descriptor record. Call build_timelines when done."""
+        if (fingerprint not in self.fingerprint_ids):
+            self.fingerprint_ids[fingerprint] = len(self.fingerprints)
+            self.fingerprints.append(fingerprint)
+        if (type_annotation not in self.type_annotations):
+            self.type_annotations.append(type_annotation)
+        self.fingerprint.append(self.fingerprint_ids[fingerprint])
+        self.published.append(published)
+        self.hibernating.append(hibernating)
+        self.source.append(source)
+        self.offset.append(offset)
+        self.length.append(length)
+        self.type_annotation.append(
+            self.type_annotations.index(type_annotation))
+
+    def add_records(self, source, type_annotation, records):
+        """Adds the (fingerprint, published, hibernating, offset, length)
+        records of one file, as returned by index_descriptor_file."""
+        for fprint, published, hibernating, offset, length in records:
+            self.add(fprint, published, hibernating, source, offset, length,
+                type_annotation)
+
+    def build_timelines(self):
+        """Sorts records by fingerprint and publication time. A later record
+        with the same fingerprint and timestamp replaces an earlier one."""
+        fingerprint = np.array(self.fingerprint, dtype=np.int32)
+        published = np.array(self.published, dtype=np.int64)
+        records = np.arange(len(published), dtype=np.int64)
+        order = np.lexsort((records, published, fingerprint))
+        fingerprint = fingerprint[order]
+        published = published[order]
+        # keep the last record of each (fingerprint, timestamp)
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (fingerprint[1:] != fingerprint[:-1]) | \
+            (published[1:] != published[:-1])
+        order = order[last]
+        fingerprint = fingerprint[last]
+        published = published[last]
+
+        starts = np.flatnonzero(np.r_[True, fingerprint[1:] != fingerprint[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        self.timelines = {}
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            fp = self.fingerprints[fingerprint[start]]
+            self.timelines[fp] = DescriptorTimeline(published[start:end],
+                order[start:end])
+
+    def _locate(self, record):
+        """Returns (source, offset, length, type annotation) of record."""
+        return self.sources[self.source[record]], self.offset[record], \
+            self.length[record], \
+            self.type_annotations[self.type_annotation[record]]
+
+    def _read(self, source, offset, length):
+        if (not isinstance(source, str)):
+            f = source
+        elif (self._open_source[0] == source):
+            f = self._open_source[1]
+        else:
+            self._close_source()
+            f = open(source, 'rb')
+            self._open_source = (source, f)
+        # pread leaves the file position alone, so forked output workers
+        # can share the open files
+        return os.pread(f.fileno(), length, offset)
+
+    def read_bytes(self, record):
+        """Returns the descriptor text of record, re-read from its source."""
+        source, offset, length, type_annotation = self._locate(record)
+        return self._read(source, offset, length)
+
+    def get_text(self, record):
+        """Returns the descriptor text of record with its metrics type
+        annotation, as written to network state files."""
+        source, offset, length, type_annotation = self._locate(record)
+        text = self._read(source, offset, length).decode('utf-8', 'replace')
+        if (type_annotation is not None):
+            return type_annotation + text
+        return text
+
+    def get_descriptor(self, record):
+        """Returns the stem descriptor of record, parsed from its text."""
+        return next(stem.descriptor.parse_file(
+            BytesIO(self.read_bytes(record)),
+            descriptor_type='server-descriptor 1.0', validate=True))
+
+    def get_nickname(self, record):
+        return self.read_bytes(record).split(None, 2)[1].decode('utf-8',
+            'replace')
+
+    def is_hibernating(self, record):
+        return bool(self.hibernating[record])
+
+    def _close_source(self):
+        if (self._open_source[1] is not None):
+            self._open_source[1].close()
+        self._open_source = (None, None)
+
+    def close(self):
+        """Closes the file held open by read_bytes and removes the spool
+        files."""
+        self._close_source()
+        for source in self.sources:
+            if (not isinstance(source, str)):
+                source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class SqliteDescriptorIndex(DescriptorIndex):
+    """DescriptorIndex stored in the SQLite database at filename, keyed by
+    fingerprint and published time. Files and archives already in the
+    database are skipped by read_descriptors, so a later run only ingests
+    new descriptors. A source is only marked indexed once all of its
+    descriptors are committed, so one that failed or was interrupted is
+    read again. Members of compressed archives are spooled to
+    filename.<source id>.spool, which is kept with the database.
+    Records are committed together with the indexed markers of their
+    sources, every commit_sources sources."""
+
+    def __init__(self, filename, commit_sources=1000):
+        self.filename = filename
+        self.commit_sources = commit_sources
+        self._uncommitted_sources = 0
+        self.db = sqlite3.connect(filename)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS sources (
+                id INTEGER PRIMARY KEY, name TEXT UNIQUE, path TEXT,
+                indexed INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS descriptors (
+                fingerprint TEXT, published INTEGER, hibernating INTEGER,
+                source INTEGER, offset INTEGER, length INTEGER,
+                type_annotation TEXT, PRIMARY KEY (fingerprint, published));
+            ''')
+        columns = [row[1] for row in
+            self.db.execute('PRAGMA table_info(sources)')]
+        if ('indexed' not in columns):
+            # sources of indexes from before the marker count as indexed
+            self.db.execute('ALTER TABLE sources ADD COLUMN '
+                'indexed INTEGER NOT NULL DEFAULT 1')
+            self.db.commit()
+        self._open_source = (None, None)
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM descriptors').fetchone()[0]
+
+    def __contains__(self, fingerprint):
+        return self.db.execute('SELECT 1 FROM descriptors WHERE '
+            'fingerprint = ? LIMIT 1', (fingerprint,)).fetchone() is not None
+
+    def __getitem__(self, fingerprint):
+        rows = self.db.execute('SELECT published, rowid FROM descriptors '
+            'WHERE fingerprint = ? ORDER BY published',
+            (fingerprint,)).fetchall()
+        if (not rows):
+            raise KeyError(fingerprint)
+        rows = np.array(rows, dtype=np.int64)
+        return DescriptorTimeline(rows[:, 0], rows[:, 1])
+
+    def count_relays(self):
+        return self.db.execute(
+            'SELECT COUNT(DISTINCT fingerprint) FROM descriptors').fetchone()[0]
+
+    def sample_records(self, sample_size, seed=None):
+        max_rowid = self.db.execute(
+            'SELECT MAX(rowid) FROM descriptors').fetchone()[0]
+        sample_size = min(sample_size, len(self))
+        rng = random.Random(seed)
+        sample = []
+        # replaced descriptors leave gaps in rowid, so skip missing ones
+        while (len(sample) < sample_size):
+            rowid = rng.randint(1, max_rowid)
+            if (rowid not in sample) and (self.db.execute('SELECT 1 FROM '
+                'descriptors WHERE rowid = ?', (rowid,)).fetchone() is not None):
+                sample.append(rowid)
+        return sample
+
+    def has_source(self, name):
+        return self.db.execute('SELECT 1 FROM sources WHERE name = ? AND '
+            'indexed = 1', (os.path.abspath(name),)).fetchone() is not None
+
+    def _get_source_id(self, name, path):
+        """Returns id of source name with path, reusing the row of an
+        earlier attempt that was not completely indexed."""
+        row = self.db.execute('SELECT id FROM sources WHERE name = ?',
+            (name,)).fetchone()
+        if (row is None):
+            return self.db.execute('INSERT INTO sources (name, path, indexed) '
+                'VALUES (?, ?, 0)', (name, path)).lastrowid
+        self.db.execute('UPDATE sources SET path = ? WHERE id = ?',
+            (path, row[0]))
+        return row[0]
+
+    def add_source(self, path, name=None):
+        path = os.path.abspath(path)
+        name = path if (name is None) else os.path.abspath(name)
+        return self._get_source_id(name, path)
+
+    def add_spool(self, name):
+        source = self._get_source_id(os.path.abspath(name), None)
+        path = os.path.abspath('{0}.{1}.spool'.format(self.filename, source))
+        self.db.execute('UPDATE sources SET path = ? WHERE id = ?',
+            (path, source))
+        return open(path, 'w+b'), source
+
+    def finish_spool(self, spool):
+        """Closes spool, which is re-opened by path for reading."""
+        spool.close()
+
+    def set_indexed(self, source):
+        """Marks source as indexed in the transaction holding its records,
+        committing every commit_sources sources."""
+        self.db.execute('UPDATE sources SET indexed = 1 WHERE id = ?',
+            (source,))
+        self._uncommitted_sources += 1
+        if (self._uncommitted_sources >= self.commit_sources):
+            self.db.commit()
+            self._uncommitted_sources = 0
+
+    def add(self, fingerprint, published, hibernating, source, offset,
+        length, type_annotation):
+        self.add_records(source, type_annotation,
+            [(fingerprint, published, hibernating, offset, length)])
+
+    def add_records(self, source, type_annotation, records):
+        """Adds the records of one file. They are committed by set_indexed
+        or build_timelines."""
+        self.db.executemany('INSERT OR REPLACE INTO descriptors VALUES '
+            '(?, ?, ?, ?, ?, ?, ?)', ((fprint, published, hibernating,
+            source, offset, length, type_annotation) for fprint,
+            published, hibernating, offset, length in records))
+
+    def build_timelines(self):
+        """Commits the records added. Timelines are queried as needed."""
+        self.db.commit()
+        self._uncommitted_sources = 0
+
+    def _locate(self, record):
+        return self.db.execute('SELECT path, offset, length, type_annotation '
+            'FROM descriptors JOIN sources ON source = id '
+            'WHERE descriptors.rowid = ?', (record,)).fetchone()
+
+    def is_hibernating(self, record):
+        return bool(self.db.execute('SELECT hibernating FROM descriptors '
+            'WHERE rowid = ?', (record,)).fetchone()[0])
+
+    def close(self):
+        """Closes the database and the file held open by read_bytes."""
+        self._close_source()
+        self.db.close()
+
+def get_contents_type_annotation(contents):
+    """Returns metrics type annotation line of the bytes contents of a
+    descriptor file, or None."""
+    first_line = contents[:contents.find(b'\n') + 1]
+    if (first_line[0:5] == b'@type'):
+        return first_line.decode('utf-8', 'replace')
+    return None
+
+def is_archive(path):
+    """Returns True if path is a .tar file, compressed or not."""
+    return os.path.isfile(path) and tarfile.is_tarfile(path)
+
+def iter_archive_members(archive_path, suffix=None):
+    """Yields (member name, offset, contents) for the files in a .tar/.tar.xz
+    archive, in archive order, streaming it without extracting to disk.
+    offset is that of the contents in the uncompressed tar stream. Only
+    member names ending in suffix are read if suffix is given."""
+    with tarfile.open(archive_path, 'r|*') as tar:
+        for member in tar:
+            if (not member.isfile()):
+                continue
+            if (suffix is not None) and (not member.name.endswith(suffix)):
+                continue
+            yield member.name, member.offset_data, \
+                tar.extractfile(member).read()
+
+def index_descriptor_file(item, trusted=False):
+    """Parses server descriptors of one file (run in worker processes if
+    read_descriptors is given workers). item is (name, source id, base
+    offset, contents), with contents None for a file on disk at name.
+    Returns (name, source id, type annotation, list of (fingerprint,
+    published timestamp, hibernating, offset, length), error message or
+    None), offsets being those of the descriptor text in the source.
+    If trusted, the file is read by parse_descriptors_trusted instead of
+    stem."""
+    name, source, base_offset, contents = item
+    try:
+        if (contents is None):
+            with open(name, 'rb') as f:
+                contents = f.read()
+        type_annotation = get_contents_type_annotation(contents)
+        records = []
+        if trusted:
+            descs = parse_descriptors_trusted(contents)
+            for i, fprint in enumerate(descs.fingerprints):
+                records.append((fprint, int(descs.published[i]),
+                    bool(descs.hibernating[i]), base_offset + descs.starts[i],
+                    descs.ends[i] - descs.starts[i]))
+            return name, source, type_annotation, records, None
+        offset = 0
+        for desc in stem.descriptor.parse_file(BytesIO(contents),
+            validate=True):
+            raw = desc.get_bytes()
+            offset = contents.index(raw, offset)
+            records.append((desc.fingerprint,
+                pathsim.timestamp(desc.published), desc.hibernating,
+                base_offset + offset, len(raw)))
+            offset += len(raw)
+    except Exception as e:
+        return name, source, None, [], str(e)
+    return name, source, type_annotation, records, None
+
+def iter_spooled_members(archive_path, source, spool, descriptors):
+    """Yields items for index_descriptor_file for the members of archive,
+    copying them to spool when spool is not None. The spool is handed to
+    descriptors.finish_spool once reading stops."""
+    try:
+        for name, offset, contents in iter_archive_members(archive_path):
+            if (spool is not None):
+                offset = spool.seek(0, os.SEEK_END)
+                spool.write(contents)
+            yield name, source, offset, contents
+    finally:
+        if (spool is not None):
+            descriptors.finish_spool(spool)
+
+def get_descriptor_files(descriptors, descriptor_dir):
+    """Returns items for index_descriptor_file for every file under
+    descriptor_dir, in sorted path order, or every member if descriptor_dir
+    is a .tar/.tar.xz archive. Files and archives that descriptors has
+    already indexed are skipped. Members of an uncompressed archive are
+    re-read from it by offset; those of a compressed one are copied to a
+    spool file, as it cannot be read at an offset. Sources are added to
+    descriptors here, as the items may be consumed in another thread."""
+    if (not is_archive(descriptor_dir)):
+        paths = sorted(os.path.join(root, filename)
+            for root, dirs, filenames in os.walk(descriptor_dir)
+            for filename in filenames)
+        return [(path, descriptors.add_source(path), 0, None)
+            for path in paths if (not descriptors.has_source(path))]
+    if (descriptors.has_source(descriptor_dir)):
+        return []
+    if (detect_compression(descriptor_dir) is None):
+        spool = None
+        source = descriptors.add_source(descriptor_dir)
+    else:
+        spool, source = descriptors.add_spool(descriptor_dir)
+    return iter_spooled_members(descriptor_dir, source, spool, descriptors)
 
 # Grabbed from https://github.com/torps/torps/processes_consensus.py
-def read_descriptors(descriptors, descriptor_dir, skip_listener):
-        """Add to descriptors contents of descriptor archive in descriptor_dir."""
+def read_descriptors(descriptors, descriptor_dir, skip_listener, workers=None,
+    trusted=False, verify_sample=0):
+        """Add to DescriptorIndex (or SqliteDescriptorIndex) descriptors
+        contents of descriptor archive in descriptor_dir, which is a directory
+        or an unextracted .tar/.tar.xz archive. If workers > 1, files are
+        parsed in that many processes, and results are added in file order.
+        If trusted, files are read by parse_descriptors_trusted, and then
+        verify_sample random indexed descriptors are checked against stem."""
 
         num_descriptors = 0    
-        num_relays = 0
+        num_relays = descriptors.count_relays()
         print('Reading descriptors from: {0}'.format(descriptor_dir))
-        reader = stem.descriptor.reader.DescriptorReader(descriptor_dir,
-            validate=True)
-        reader.register_skip_listener(skip_listener)
-        # use read listener to store metrics type annotation, which is otherwise discarded
-        cur_type_annotation = [None]
-        def read_listener(path):
-            f = open(path)
-            # store initial metrics type annotation
-            initial_position = f.tell()
-            first_line = f.readline()
-            f.seek(initial_position)
-            if (first_line[0:5] == '@type'):
-                cur_type_annotation[0] = first_line
-            else:
-                cur_type_annotation[0] = None
-            f.close()
-        reader.register_read_listener(read_listener)
-        with reader:
-            for desc in reader:
-                if (num_descriptors % 10000 == 0):
+        items = get_descriptor_files(descriptors, descriptor_dir)
+        index_file = functools.partial(index_descriptor_file, trusted=trusted)
+        pool = None
+        if (workers is not None) and (workers > 1):
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(index_file, items, 64)
+        else:
+            results = map(index_file, items)
+        try:
+            # results come in item order, so a source (a file, or all
+            # members of an archive) is complete when the next one starts
+            current = None
+            failed = False
+            for name, source, type_annotation, records, error in results:
+                if (source != current):
+                    if (current is not None) and (not failed):
+                        descriptors.set_indexed(current)
+                    current = source
+                    failed = False
+                if (error is not None):
+                    skip_listener(name, error)
+                    failed = True
+                descriptors.add_records(source, type_annotation, records)
+                previous = num_descriptors
+                num_descriptors += len(records)
+                if (num_descriptors // 10000 > previous // 10000):
                     print('{0} descriptors processed.'.format(num_descriptors))
-                num_descriptors += 1
-                if (desc.fingerprint not in descriptors):
-                    descriptors[desc.fingerprint] = {}
-                    num_relays += 1
-                    # stuff type annotation into stem object
-                desc.type_annotation = cur_type_annotation[0]
-                descriptors[desc.fingerprint]\
-                    [pathsim.timestamp(desc.published)] = desc
+            if (current is not None) and (not failed):
+                descriptors.set_indexed(current)
+        finally:
+            if (pool is not None):
+                pool.terminate()
+        descriptors.build_timelines()
+        if trusted and (verify_sample > 0):
+            for record in descriptors.sample_records(verify_sample):
+                parse_descriptors_trusted(descriptors.read_bytes(record),
+                    verify_sample=1)
+        num_relays = descriptors.count_relays() - num_relays
         print('#descriptors: {0}; #relays:{1}'.\
             format(num_descriptors,num_relays)) 
 
+def skip_listener(path, exception):
+    print('ERROR [{0}]: {1}'.format(path.encode('ascii', 'ignore'), str(exception).encode('ascii','ignore')))
+
 # Modified from https://github.com/torps/torps/processes_consensus.py
-def process_consensus(consensus_filename, descriptor_dir):
+def process_consensus(consensus_filename, descriptor_dir, trusted=False,
+    verify_sample=0, compression=None, descriptors=None, workers=None,
+    consensus_file=None, index_filename=None):
     """For every input consensus, finds the descriptors published most recently before the descriptor times listed for the relays in that consensus, records state changes indicated by descriptors published during the consensus fresh period, and writes out pickled consensus and descriptor objects with the relevant information.
         Inputs:
             consensus_filename: filename of consensus (e.g. "dirpath/2018-08-02-00-00-00-consensus")
             descriptor_dir: Contains descriptors from the month of the consensus.
+            trusted: read the consensus and descriptors with parse_consensus_trusted and parse_descriptors_trusted instead of stem
+            verify_sample: number of router entries, and of descriptors, the trusted parsers check against stem
+            compression: compress network state files with 'lzma', 'gzip' or 'bz2' (None writes them uncompressed)
+            descriptors: DescriptorIndex already read by read_descriptors, in which case descriptor_dir is not read
+            workers: number of processes that parse descriptor files (None reads them in this process)
+            consensus_file: binary file object holding the consensus, read instead of opening consensus_filename (e.g. a member of a consensus archive)
+            index_filename: SQLite descriptor index (SqliteDescriptorIndex) that descriptor_dir is added to, so that only descriptors not yet indexed are read
     """
     fat = True
     desc_out_dir = "out/network-state-yyyy-mm"
-    descriptors = {}
-    def skip_listener(path, exception):
-        print('ERROR [{0}]: {1}'.format(path.encode('ascii', 'ignore'), exception.__unicode__().encode('ascii','ignore')))
         
-    # initialize descriptors
-    if (descriptor_dir is not None):
-        read_descriptors(descriptors, descriptor_dir, skip_listener)
+    # initialize descriptors, closed (removing spool files) when done
+    if (descriptors is None):
+        if (index_filename is not None):
+            descriptors = SqliteDescriptorIndex(index_filename)
+        else:
+            descriptors = DescriptorIndex()
+        with descriptors:
+            if (descriptor_dir is not None):
+                read_descriptors(descriptors, descriptor_dir, skip_listener,
+                    workers, trusted, verify_sample)
+            return process_consensus(consensus_filename, None, trusted,
+                verify_sample, compression, descriptors,
+                consensus_file=consensus_file)
 
     # output pickled consensuses, dict of most recent descriptors, and 
     # list of hibernation status changes
 
     print('Processing consensus file {0}'.format(consensus_filename))
-    cons_f = open(consensus_filename, 'rb')
+    if (consensus_file is not None):
+        cons_f = consensus_file
+    else:
+        cons_f = open(consensus_filename, 'rb')
 
     # store metrics type annotation line
     initial_position = cons_f.tell()
     first_line = cons_f.readline()
-    if (first_line[0:5] == '@type'):
-        type_annotation = first_line
+    if (first_line[0:5] == b'@type'):
+        type_annotation = first_line.decode('utf-8')
     else:
         type_annotation = None
     cons_f.seek(initial_position)
@@ -89,8 +606,13 @@ def process_consensus(consensus_filename, descriptor_dir):
     num_found = 0
     # read in consensus document
     i = 0
-    for document in stem.descriptor.parse_file(cons_f, validate=True,
-        document_handler='DOCUMENT'):
+    if trusted:
+        documents = [parse_consensus_trusted(cons_f.read(),
+            verify_sample)]
+    else:
+        documents = stem.descriptor.parse_file(cons_f, validate=True,
+            document_handler='DOCUMENT')
+    for document in documents:
         if (i > 0):
             raise ValueError('Unexpectedly found more than one consensus in file: {}'.\
                 format(consensus_filename))
@@ -109,7 +631,7 @@ def process_consensus(consensus_filename, descriptor_dir):
                 ('bwweightscale' in document.params):
                 cons_bwweightscale = document.params[\
                         'bwweightscale']
-            for fprint, r_stat in document.routers.iteritems():
+            for fprint, r_stat in document.routers.items():
                 relays[fprint] = pathsim.RouterStatusEntry(fprint, r_stat.nickname,
                     r_stat.flags, r_stat.bandwidth)
         consensus = document
@@ -119,77 +641,65 @@ def process_consensus(consensus_filename, descriptor_dir):
         # find relays' most recent unexpired descriptor published
         # before the publication time in the consensus
         # and status changes in fresh period (i.e. hibernation)
-        for fprint, r_stat in consensus.routers.iteritems():
+        for fprint, r_stat in consensus.routers.items():
             pub_time = pathsim.timestamp(r_stat.published)
             desc_time = 0
             descs_while_fresh = []
             desc_time_fresh = None
             # get all descriptors with this fingerprint
             if (r_stat.fingerprint in descriptors):
-                for t,d in descriptors[r_stat.fingerprint].items():
-                    # update most recent desc seen before cons pubtime
-                    # allow pubtime after valid_after but not fresh_until
-                    if (valid_after_ts-t <\
-                        pathsim.TorOptions.router_max_age) and\
-                        (t <= pub_time) and (t > desc_time) and\
-                        (t <= fresh_until_ts):
-                        desc_time = t
-                    # store fresh-period descs for hibernation tracking
-                    if (t >= valid_after_ts) and \
-                        (t <= fresh_until_ts):
-                        descs_while_fresh.append((t,d))                                
-                    # find most recent hibernating stat before fresh period
-                    # prefer most-recent descriptor before fresh period
-                    # but use oldest after valid_after if necessary
-                    if (desc_time_fresh == None):
-                        desc_time_fresh = t
-                    elif (desc_time_fresh < valid_after_ts):
-                        if (t > desc_time_fresh) and\
-                            (t <= valid_after_ts):
-                            desc_time_fresh = t
-                    else:
-                        if (t < desc_time_fresh):
-                            desc_time_fresh = t
+                timeline = descriptors[r_stat.fingerprint]
+                # most recent unexpired desc seen before cons pubtime
+                # allow pubtime after valid_after but not fresh_until
+                desc_time = timeline.latest(\
+                    valid_after_ts - pathsim.TorOptions.router_max_age,\
+                    min(pub_time, fresh_until_ts))
+                # store fresh-period descs for hibernation tracking
+                descs_while_fresh = timeline.between(valid_after_ts,\
+                    fresh_until_ts)
+                # find most recent hibernating stat before fresh period
+                # prefer most-recent descriptor before fresh period
+                # but use oldest after valid_after if necessary
+                desc_time_fresh = timeline.baseline(valid_after_ts)
 
             # output best descriptor if found
             if (desc_time != 0):
                 num_found += 1
                 # store discovered recent descriptor
-                desc = descriptors[r_stat.fingerprint][desc_time]
+                record = timeline[desc_time]
                 if not fat:
+                    desc = descriptors.get_descriptor(record)
                     descriptors_out[r_stat.fingerprint] = \
                         pathsim.ServerDescriptor(desc.fingerprint, \
                             desc.hibernating, desc.nickname, \
                             desc.family, desc.address, \
                             desc.exit_policy, desc.ntor_onion_key)
                 else:
-                    if (desc.type_annotation is not None):
-                        descriptors_out[r_stat.fingerprint] = desc.type_annotation + str(desc)
-                    else:
-                        descriptors_out[r_stat.fingerprint] = str(desc)
+                    descriptors_out[r_stat.fingerprint] = \
+                        descriptors.get_text(record)
                  
                 # store hibernating statuses
                 if (desc_time_fresh == None):
                     raise ValueError('Descriptor error for {0}:{1}.\n Found  descriptor before published date {2}: {3}\nDid not find descriptor for initial hibernation status for fresh period starting {4}.'.format(r_stat.nickname, r_stat.fingerprint, pub_time, desc_time, valid_after_ts))
-                desc = descriptors[r_stat.fingerprint][desc_time_fresh]
-                cur_hibernating = desc.hibernating
+                record = timeline[desc_time_fresh]
+                cur_hibernating = descriptors.is_hibernating(record)
                 # setting initial status
-                hibernating_statuses.append((0, desc.fingerprint,\
+                hibernating_statuses.append((0, r_stat.fingerprint,\
                     cur_hibernating))
                 if (cur_hibernating):
-                    print('{0}:{1} was hibernating at consenses period start'.format(desc.nickname, desc.fingerprint))
+                    print('{0}:{1} was hibernating at consenses period start'.format(descriptors.get_nickname(record), r_stat.fingerprint))
                 descs_while_fresh.sort(key = lambda x: x[0])
                 for (t,d) in descs_while_fresh:
-                    if (d.hibernating != cur_hibernating):
-                        cur_hibernating = d.hibernating                                   
+                    if (descriptors.is_hibernating(d) != cur_hibernating):
+                        cur_hibernating = descriptors.is_hibernating(d)
                         hibernating_statuses.append(\
-                            (t, d.fingerprint, cur_hibernating))
+                            (t, r_stat.fingerprint, cur_hibernating))
                         if (cur_hibernating):
                             print('{0}:{1} started hibernating at {2}'\
-                                .format(d.nickname, d.fingerprint, t))
+                                .format(descriptors.get_nickname(d), r_stat.fingerprint, t))
                         else:
                             print('{0}:{1} stopped hibernating at {2}'\
-                                .format(d.nickname, d.fingerprint, t))                   
+                                .format(descriptors.get_nickname(d), r_stat.fingerprint, t))                   
             else:
 #                            print(\
 #                            'Descriptor not found for {0}:{1}:{2}'.format(\
@@ -214,11 +724,15 @@ def process_consensus(consensus_filename, descriptor_dir):
             outpath = os.path.join(desc_out_dir,\
                 cons_valid_after.strftime(\
                     '%Y-%m-%d-%H-%M-%S-network_state'))
-            f = open(outpath, 'wb')
+            # write to a temporary file and rename, so that readers never
+            # see a partial network state
+            tmp_outpath = '{0}.{1}.tmp'.format(outpath, os.getpid())
+            f = open_network_state(tmp_outpath, 'wb', compression)
             pickle.dump(consensus_out, f, pickle.HIGHEST_PROTOCOL)
             pickle.dump(descriptors_out,f,pickle.HIGHEST_PROTOCOL)
             pickle.dump(hibernating_statuses,f,pickle.HIGHEST_PROTOCOL)
             f.close()
+            os.replace(tmp_outpath, outpath)
 
             print('Wrote descriptors for {0} relays.'.\
                 format(num_found))
@@ -232,5 +746,84 @@ def process_consensus(consensus_filename, descriptor_dir):
                 
 
 
+def iter_consensus_files(consensus_dir):
+    """Yields (filename, contents) for the consensuses in consensus_dir, in
+    sorted order, with contents None, or (member name, contents) for those
+    in a consensuses-yyyy-mm.tar.xz archive, in archive order."""
+    if (is_archive(consensus_dir)):
+        for name, offset, contents in iter_archive_members(consensus_dir,
+            '-consensus'):
+            yield name, contents
+    else:
+        consensus_filenames = sorted(filename
+            for filename in os.listdir(consensus_dir)
+            if filename.endswith('-consensus'))
+        for filename in consensus_filenames:
+            yield os.path.join(consensus_dir, filename), None
+
+# descriptor index and process_consensus options of forked output workers
+_output_descriptors = None
+_output_kwargs = {}
+
+def _init_output_worker(index_filename, kwargs):
+    global _output_descriptors, _output_kwargs
+    # a SQLite connection cannot be used across fork, so open a new one
+    if (index_filename is not None):
+        _output_descriptors = SqliteDescriptorIndex(index_filename)
+    _output_kwargs = kwargs
+
+def _process_consensus_file(item):
+    consensus_filename, contents = item
+    process_consensus(consensus_filename, None,
+        descriptors=_output_descriptors,
+        consensus_file=None if (contents is None) else BytesIO(contents),
+        **_output_kwargs)
+    return consensus_filename
+
+def process_consensus_dir(consensus_dir, descriptor_dir, trusted=False,
+    verify_sample=0, compression=None, workers=None, index_filename=None,
+    output_workers=None):
+    """Runs process_consensus on every consensus file in consensus_dir, in order, reading the descriptors in descriptor_dir only once.
+        Inputs:
+            consensus_dir: Contains consensuses (e.g. the hourly consensuses of one month), or an unextracted consensuses-yyyy-mm.tar.xz archive, whose members are processed in archive order
+            descriptor_dir: Contains descriptors from the month of the consensuses, or an unextracted server-descriptors-yyyy-mm.tar.xz archive.
+            trusted, verify_sample, compression, workers, index_filename: as for process_consensus
+            output_workers: number of processes forked after reading the descriptors that each write the network states of a disjoint set of consensuses (None writes them in this process)
+    """
+    global _output_descriptors
+    if (index_filename is not None):
+        descriptors = SqliteDescriptorIndex(index_filename)
+    else:
+        descriptors = DescriptorIndex()
+    with descriptors:
+        if (descriptor_dir is not None):
+            read_descriptors(descriptors, descriptor_dir, skip_listener,
+                workers, trusted, verify_sample)
+
+        kwargs = {'trusted': trusted, 'verify_sample': verify_sample,
+            'compression': compression}
+        items = iter_consensus_files(consensus_dir)
+        if (output_workers is not None) and (output_workers > 1):
+            # workers inherit the in-memory index copy-on-write
+            _output_descriptors = descriptors
+            if (index_filename is not None):
+                descriptors.close()
+            context = multiprocessing.get_context('fork')
+            try:
+                with context.Pool(output_workers, _init_output_worker,
+                    (index_filename, kwargs)) as pool:
+                    for consensus_filename in pool.imap_unordered(
+                        _process_consensus_file, items):
+                        pass
+            finally:
+                _output_descriptors = None
+        else:
+            for consensus_filename, contents in items:
+                process_consensus(consensus_filename, None,
+                    descriptors=descriptors,
+                    consensus_file=None if (contents is None) else BytesIO(contents),
+                    **kwargs)
+
+
 if __name__ == '__main__':
     process_consensus("in/yyyy-mm-dd-hh-00-00-consensus", "in/server-descriptors-yyyy-mm")
\ No newline at end of file
@@ -6,33 +6,219 @@ Author: Gerry Wan
 Functions to grab relays and weights from Tor consensus files.
 """
 
-import argparse
+from array import array
+import base64
+import binascii
+import bisect
+import bz2
+from collections import deque
+from collections.abc import Mapping
+import concurrent.futures
 import datetime
+import gzip
 from io import BytesIO
 import ipaddress
+import itertools
+import json
+import lzma
 import pickle
 import re
 import math
+import multiprocessing
+import os
+import random
+import struct
 
-from stem import Flag
-import stem.descriptor
+import numpy as np
+# stem is imported by the functions that parse consensuses and descriptors,
+# so that modules which only read guard records do not pay for it.
 
 DEFAULT_BWWEIGHTSCALE = 10000
 
+# Bit position of each relay flag in a flag bitmask. The order is part of the
+# snapshot file format, so only ever append to this list.
+RELAY_FLAGS = ['Authority', 'BadExit', 'BadDirectory', 'Exit', 'Fast', 'Guard',
+    'HSDir', 'Named', 'NoEdConsensus', 'Running', 'Stable', 'StaleDesc',
+    'Unnamed', 'V2Dir', 'V3Dir', 'Valid']
+FLAG_BITS = {flag: 1 << i for i, flag in enumerate(RELAY_FLAGS)}
+
+SNAPSHOT_MAGIC = b'GPASNAP1'
+SNAPSHOT_ALIGNMENT = 64
+
 # Modified from torps pathsim
 class NetworkState:
     """
     Contains slimmed down version of Tor network state in a consensus period.
+    relay_columns holds the per-relay arrays when loaded from a snapshot.
+    hibernation is the HibernationTimeline of the period, if known.
+    cons_bw_totals holds the bandwidth-weight class totals over every
+    router in the consensus (see get_bw_weight_totals), if known.
     """
     
     def __init__(self, cons_rel_stats, descriptors, cons_valid_after,
-        cons_fresh_until, cons_bw_weights, cons_bwweightscale):
+        cons_fresh_until, cons_bw_weights, cons_bwweightscale,
+        relay_columns=None, hibernation=None, cons_bw_totals=None):
         self.cons_rel_stats = cons_rel_stats
         self.descriptors = descriptors
         self.cons_valid_after = cons_valid_after
         self.cons_fresh_until = cons_fresh_until
         self.cons_bw_weights = cons_bw_weights
         self.cons_bwweightscale = cons_bwweightscale
+        self.relay_columns = relay_columns
+        self.hibernation = hibernation
+        self.cons_bw_totals = cons_bw_totals
+
+
+class RelayRecord:
+    """
+    Lightweight consensus entry carrying the RouterStatusEntry fields
+    used by the analyses.
+    """
+
+    __slots__ = ('fingerprint', 'address', 'flags', 'bandwidth', 'nickname',
+        'published')
+
+    def __init__(self, fingerprint, address, flags, bandwidth, nickname=None,
+        published=None):
+        self.fingerprint = fingerprint
+        self.address = address
+        self.flags = flags
+        self.bandwidth = bandwidth
+        self.nickname = nickname
+        self.published = published
+
+    def __repr__(self):
+        return 'RelayRecord({0}, {1})'.format(self.fingerprint, self.address)
+
+
+class GuardRecord:
+    """
+    Compact guard entry used as the key of guard_to_bw. Keeps only the
+    fingerprint and address, the fields the analysis scripts read from
+    guard_to_bw keys, and the valid-after time of the consensus the guard
+    was taken from (None for older pickles), which selects the bandwidth
+    model (see get_guard_bw_model); the flags, bandwidth, exit policy,
+    family and other fields of the stem router status entry are not kept.
+    Compares and hashes by fingerprint, and pickles as a plain
+    (fingerprint, address, valid_after) tuple.
+    """
+
+    __slots__ = ('fingerprint', 'address', 'valid_after')
+
+    def __init__(self, fingerprint, address, valid_after=None):
+        self.fingerprint = fingerprint
+        self.address = address
+        self.valid_after = valid_after
+
+    def __eq__(self, other):
+        return isinstance(other, GuardRecord) and \
+            (self.fingerprint == other.fingerprint)
+
+    def __hash__(self):
+        return hash(self.fingerprint)
+
+    def __reduce__(self):
+        return (GuardRecord, (self.fingerprint, self.address,
+            self.valid_after))
+
+    def __repr__(self):
+        return 'GuardRecord({0}, {1})'.format(self.fingerprint, self.address)
+
+
+class DescriptorRecord:
+    """
+    Lightweight server descriptor carrying the fields used by the analyses.
+    family is None when not known (e.g. for snapshot records).
+    """
+
+    __slots__ = ('fingerprint', 'address', 'average_bandwidth',
+        'observed_bandwidth', 'published', 'hibernating', 'family')
+
+    def __init__(self, fingerprint, address, average_bandwidth,
+        observed_bandwidth, published=None, hibernating=False, family=None):
+        self.fingerprint = fingerprint
+        self.address = address
+        self.average_bandwidth = average_bandwidth
+        self.observed_bandwidth = observed_bandwidth
+        self.published = published
+        self.hibernating = hibernating
+        self.family = family
+
+    def __repr__(self):
+        return 'DescriptorRecord({0}, {1})'.format(self.fingerprint, self.address)
+
+
+class HibernationTimeline:
+    """
+    Hibernation changes in a consensus period as columns sorted by relay and
+    time: times (int64), relays (index into the sorted fingerprints array)
+    and states (bool). Time 0 entries give each relay's state at the start
+    of the period. Relays without entries are taken to be awake.
+    Times must be in [0, 2**32), as they are packed into 32 bits.
+    """
+
+    def __init__(self, fingerprints, times, relays, states):
+        order = np.lexsort((times, relays))
+        self.fingerprints = fingerprints
+        self.times = np.asarray(times, dtype=np.int64)[order]
+        self.relays = np.asarray(relays, dtype=np.int64)[order]
+        self.states = np.asarray(states, dtype=bool)[order]
+        if (len(self.times) > 0) and ((self.times.min() < 0) or
+            (self.times.max() >= (1 << 32))):
+            raise ValueError('Hibernation times must be in [0, 2**32)')
+        # (relay, time) packed into one sorted key for binary search
+        self._keys = (self.relays << 32) | self.times
+
+    def __len__(self):
+        return len(self.times)
+
+    def _relay_states(self, t):
+        """Returns the state of every relay in fingerprints at time t."""
+        t = int(t)
+        if (t < 0) or (t >= (1 << 32)):
+            raise ValueError('Time {0} is outside [0, 2**32)'.format(t))
+        relays = np.arange(len(self.fingerprints), dtype=np.int64)
+        last = np.searchsorted(self._keys, (relays << 32) | t, 'right') - 1
+        found = last >= 0
+        found[found] = self.relays[last[found]] == relays[found]
+        hibernating = np.zeros(len(relays), dtype=bool)
+        hibernating[found] = self.states[last[found]]
+        return hibernating
+
+    def get_hibernating(self, t):
+        """Returns sorted array of fingerprints hibernating at time t."""
+        return self.fingerprints[self._relay_states(t)]
+
+    def get_hibernating_mask(self, t, fingerprints):
+        """Returns boolean mask of the relays in fingerprints (e.g. as
+        returned by get_network_weights) that are hibernating at time t."""
+        fingerprints = np.asarray(fingerprints, dtype='U40')
+        if (len(self.fingerprints) == 0):
+            return np.zeros(len(fingerprints), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.fingerprints, fingerprints),
+            len(self.fingerprints) - 1)
+        known = self.fingerprints[pos] == fingerprints
+        return known & self._relay_states(t)[pos]
+
+    def is_hibernating(self, fingerprint, t):
+        return bool(self.get_hibernating_mask(t, [fingerprint])[0])
+
+
+def get_hibernation_timeline(hibernating_statuses):
+    """
+    Returns HibernationTimeline of the (time, fingerprint, hibernating)
+    list written by process_consensus.
+    """
+
+    fprints = [fp.decode('utf-8') if isinstance(fp, bytes) else fp
+        for t, fp, hibernating in hibernating_statuses]
+    fingerprints, relays = np.unique(np.array(fprints, dtype='U40'),
+        return_inverse=True)
+    times = np.fromiter((t for t, fp, hibernating in hibernating_statuses),
+        dtype=np.int64, count=len(hibernating_statuses))
+    states = np.fromiter((hibernating for t, fp, hibernating in
+        hibernating_statuses), dtype=bool, count=len(hibernating_statuses))
+    return HibernationTimeline(fingerprints, times, relays, states)
 
 
 # Grabbed from torps pathsim
@@ -45,6 +231,26 @@ def pathsim_timestamp(t):
     return ts
 
 
+def flags_to_bitmask(flags):
+    """
+    Returns integer bitmask of relay flags (see RELAY_FLAGS).
+    Flags not in RELAY_FLAGS are ignored.
+    """
+
+    mask = 0
+    for flag in flags:
+        mask |= FLAG_BITS.get(flag, 0)
+    return mask
+
+
+def bitmask_to_flags(mask):
+    """
+    Returns list of relay flags set in bitmask.
+    """
+
+    return [flag for flag, bit in FLAG_BITS.items() if (mask & bit)]
+
+
 def get_relay_list(cons_rel_stats):
     """
     Returns all relays in consensus
@@ -57,39 +263,51 @@ def get_relay_list(cons_rel_stats):
 def get_guard_list(cons_rel_stats, descriptors):
     """
     Returns relays filtered by general (non-client-specific) guard criteria.
-    In particular, omits checks for IP/family/subnet conflicts within list. 
+    In particular, omits checks for IP/family/subnet conflicts within list
+    (see GuardConflictIndex). 
     """
 
-    guards = []
+    rel_stats = list(cons_rel_stats.values())
+    has_descriptor = np.fromiter((fprint in descriptors
+        for fprint in cons_rel_stats), dtype=bool, count=len(rel_stats))
+    guard_mask = get_guard_mask(get_flag_bitmasks(rel_stats), has_descriptor)
 
-    for fprint in cons_rel_stats:
-        rel_stat = cons_rel_stats[fprint]
-        if ((Flag.RUNNING in rel_stat.flags) 
-            and (Flag.VALID in rel_stat.flags) 
-            and (Flag.GUARD in rel_stat.flags) 
-            and (Flag.FAST in rel_stat.flags)
-            and (Flag.STABLE in rel_stat.flags)
-            and (Flag.V2DIR in rel_stat.flags)
-            and (fprint in descriptors)):
-            guards.append(rel_stat)
-
-    return guards
+    return [rel_stats[i] for i in np.flatnonzero(guard_mask)]
     
 
 # Modified from torps pathsim.py
 def get_guard_weights(guard_list, bw_weights, bwweightscale):
     """Returns un-normalized bandwidth for each guard in guard_list"""
 
-    guards_to_bw_weight = {}
-    for guard in guard_list:
-        bw = float(guard.bandwidth)
-        weight = (float(pathsim_get_bw_weight(guard.flags,'g', bw_weights)) /
-                  float(bwweightscale))
-        bw_weight = bw * weight
+    bandwidths = np.array([float(guard.bandwidth) for guard in guard_list],
+        dtype=np.float64)
+    bw_weight = get_position_weights(get_flag_bitmasks(guard_list), bandwidths,
+        bw_weights, bwweightscale, 'g')
+
+    return dict(zip(guard_list, bw_weight.tolist()))
+
+def get_guard_records(guard_to_bw, valid_after=None):
+    """
+    Returns guard_to_bw with each guard (e.g. a stem RouterStatusEntryV3)
+    replaced by a GuardRecord, keeping order. valid_after is the
+    valid-after time of the consensus the guards were taken from.
+    """
+
+    return {GuardRecord(guard.fingerprint, guard.address, valid_after): bw
+        for guard, bw in guard_to_bw.items()}
 
-        guards_to_bw_weight[guard] = bw_weight
+def load_guard_to_bw(filename):
+    """
+    Loads a guard_to_bw pickle written by gen_relay_info.py. Older pickles
+    keyed by stem RouterStatusEntryV3 objects (which need stem to unpickle)
+    are converted to GuardRecord keys.
+    """
 
-    return guards_to_bw_weight
+    with open(filename, 'rb') as f:
+        guard_to_bw = pickle.load(f)
+    if not all(isinstance(guard, GuardRecord) for guard in guard_to_bw):
+        guard_to_bw = get_guard_records(guard_to_bw)
+    return guard_to_bw
 
     
 # Grabbed from torps pathsim.py
@@ -101,51 +319,810 @@ def pathsim_get_bw_weight(flags, position, bw_weights):
         NetworkStatusDocumentV3 consensus """
 
     if (position == 'g'):
-        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
+        if ('Guard' in flags) and ('Exit' in flags):
             return bw_weights['Wgd']
-        elif (Flag.GUARD in flags):
+        elif ('Guard' in flags):
             return bw_weights['Wgg']
-        elif (Flag.EXIT not in flags):
+        elif ('Exit' not in flags):
             return bw_weights['Wgm']
         else:
             raise ValueError('Wge weight does not exist.')
+    elif (position == 'm'):
+        if ('Guard' in flags) and ('Exit' in flags):
+            return bw_weights['Wmd']
+        elif ('Guard' in flags):
+            return bw_weights['Wmg']
+        elif ('Exit' in flags):
+            return bw_weights['Wme']
+        else:
+            return bw_weights['Wmm']
+    elif (position == 'e'):
+        if ('Guard' in flags) and ('Exit' in flags):
+            return bw_weights['Wed']
+        elif ('Guard' in flags):
+            return bw_weights['Weg']
+        elif ('Exit' in flags):
+            return bw_weights['Wee']
+        else:
+            return bw_weights['Wem']
     else:
-        raise NotImplementedError()
+        raise ValueError('get_weight does not support position {0}.'.format(
+            position))
+
+
+# Flags a relay needs to be a guard (see get_guard_list)
+GUARD_FLAGS_MASK = (FLAG_BITS['Running'] | FLAG_BITS['Valid'] |
+    FLAG_BITS['Guard'] | FLAG_BITS['Fast'] | FLAG_BITS['Stable'] |
+    FLAG_BITS['V2Dir'])
+
+# Bandwidth weight names for each position, in the order
+# (Guard and Exit, Guard only, Exit only, neither). None if no weight exists.
+POSITION_BW_WEIGHTS = {
+    'g': ('Wgd', 'Wgg', None, 'Wgm'),
+    'm': ('Wmd', 'Wmg', 'Wme', 'Wmm'),
+    'e': ('Wed', 'Weg', 'Wee', 'Wem'),
+}
+
+
+def get_flag_bitmasks(relay_list):
+    """
+    Returns numpy array of flag bitmasks for relays in relay_list.
+    """
+
+    # relays share a small number of distinct flag sets
+    bitmasks = {}
+    def bitmask(flags):
+        flags = tuple(flags)
+        mask = bitmasks.get(flags)
+        if mask is None:
+            mask = bitmasks[flags] = flags_to_bitmask(flags)
+        return mask
+
+    return np.fromiter((bitmask(relay.flags) for relay in relay_list),
+        dtype=np.uint32, count=len(relay_list))
+
+
+def get_guard_mask(flag_bitmasks, has_descriptor=None):
+    """
+    Returns boolean numpy array marking relays that meet the general guard
+    criteria of get_guard_list.
+
+    flag_bitmasks:  array of relay flag bitmasks
+    has_descriptor: optional boolean array, False for relays without a
+                    descriptor
+    """
+
+    guard_mask = (flag_bitmasks & GUARD_FLAGS_MASK) == GUARD_FLAGS_MASK
+    if has_descriptor is not None:
+        guard_mask &= has_descriptor
+    return guard_mask
+
+
+def get_position_weights(flag_bitmasks, bandwidths, bw_weights, bwweightscale,
+    position):
+    """
+    Returns numpy array of un-normalized bandwidth weights for the given
+    position ('g', 'm' or 'e'), vectorized version of pathsim_get_bw_weight
+    applied to each relay's bandwidth.
+
+    flag_bitmasks: array of relay flag bitmasks
+    bandwidths:    array of consensus bandwidths
+    bw_weights:    bandwidth_weights from consensus
+    bwweightscale: bandwidth weight scale from consensus
+    """
+
+    if position not in POSITION_BW_WEIGHTS:
+        raise ValueError('get_weight does not support position {0}.'.format(
+            position))
+    is_guard = (flag_bitmasks & FLAG_BITS['Guard']) != 0
+    is_exit = (flag_bitmasks & FLAG_BITS['Exit']) != 0
+    classes = [is_guard & is_exit, is_guard & ~is_exit, ~is_guard & is_exit,
+        ~is_guard & ~is_exit]
+
+    weights = np.zeros(len(flag_bitmasks), dtype=np.float64)
+    for name, in_class in zip(POSITION_BW_WEIGHTS[position], classes):
+        if not in_class.any():
+            continue
+        if name is None:
+            raise ValueError('W{0}e weight does not exist.'.format(position))
+        weights[in_class] = float(bw_weights[name])
+
+    return np.asarray(bandwidths, dtype=np.float64) * \
+        (weights / float(bwweightscale))
+
+
+def get_relay_arrays(network_state):
+    """
+    Returns (fingerprints, flag bitmasks, consensus bandwidths) numpy arrays
+    for the relays in network_state.cons_rel_stats, in iteration order.
+    Uses the snapshot columns when available. Missing bandwidths are -1.
+    """
+
+    columns = network_state.relay_columns
+    if columns is not None:
+        return (columns['fingerprint'].astype('U40'), columns['flags'],
+            columns['bandwidth'])
+
+    rel_stats = list(network_state.cons_rel_stats.values())
+    fingerprints = np.array(list(network_state.cons_rel_stats), dtype='U40')
+    bandwidths = np.fromiter((-1 if rel_stat.bandwidth is None else
+        rel_stat.bandwidth for rel_stat in rel_stats), dtype=np.int64,
+        count=len(rel_stats))
+    return fingerprints, get_flag_bitmasks(rel_stats), bandwidths
+
+
+def get_network_weights(network_state, positions=('g', 'm', 'e'),
+    at_time=None):
+    """
+    Returns (fingerprints, guard mask, dict mapping position to weights)
+    for every relay in network_state, computed over the whole consensus at
+    once. Guard weights are 0 for relays that are not guards, and missing
+    bandwidths count as 0. If at_time is given, relays hibernating then
+    (per network_state.hibernation) are left out of the guard mask and get
+    weight 0.
+    """
+
+    fingerprints, flag_bitmasks, bandwidths = get_relay_arrays(network_state)
+    bandwidths = np.maximum(bandwidths, 0)
+    # cons_rel_stats only holds relays with descriptors
+    guard_mask = get_guard_mask(flag_bitmasks)
+    hibernating = None
+    if (at_time is not None) and (network_state.hibernation is not None):
+        hibernating = network_state.hibernation.get_hibernating_mask(at_time,
+            fingerprints)
+        guard_mask &= ~hibernating
+
+    position_weights = {}
+    for position in positions:
+        if (position == 'g'):
+            weights = np.zeros(len(fingerprints), dtype=np.float64)
+            weights[guard_mask] = get_position_weights(
+                flag_bitmasks[guard_mask], bandwidths[guard_mask],
+                network_state.cons_bw_weights,
+                network_state.cons_bwweightscale, 'g')
+        else:
+            weights = get_position_weights(flag_bitmasks, bandwidths,
+                network_state.cons_bw_weights,
+                network_state.cons_bwweightscale, position)
+            if (hibernating is not None):
+                weights[hibernating] = 0
+        position_weights[position] = weights
+
+    return fingerprints, guard_mask, position_weights
+
+
+def _tor_div(a, b):
+    """Integer division truncating toward zero, as in C."""
+    q = abs(a) // abs(b)
+    return q if ((a < 0) == (b < 0)) else -q
+
+
+def _check_bw_weights(Wgg, Wgd, Wmg, Wme, Wmd, Wee, Wed, weight_scale, G, M,
+    E, D, T, margin=10):
+    """
+    Returns None if the weights satisfy the dir-spec constraints, else the
+    name of the first violated constraint. Port of Tor's
+    networkstatus_check_weights, in the same order and in the same integer
+    arithmetic on scaled weights: the sums must be within margin of
+    weight_scale, every weight in [0, weight_scale], and the balance
+    equations within (margin*T)/3.
+    """
+
+    if (abs(Wed + Wmd + Wgd - weight_scale) > margin):
+        return 'sumd'
+    if (abs(Wmg + Wgg - weight_scale) > margin):
+        return 'sumg'
+    if (abs(Wme + Wee - weight_scale) > margin):
+        return 'sume'
+    if any((w < 0) or (w > weight_scale)
+        for w in (Wgg, Wgd, Wmg, Wme, Wmd, Wee, Wed)):
+        return 'range'
+    balance_margin = _tor_div(margin*T, 3)
+    if (abs(Wgg*G + Wgd*D - (Wee*E + Wed*D)) > balance_margin):
+        return 'balance_eg'
+    if (abs(Wgg*G + Wgd*D - (M*weight_scale + Wmd*D + Wme*E + Wmg*G)) >
+        balance_margin):
+        return 'balance_mid'
+    return None
+
+
+def compute_bw_weights(G, M, E, D, weight_scale=DEFAULT_BWWEIGHTSCALE):
+    """
+    Returns the bandwidth-weights dict directory authorities would put in
+    a consensus with total guard-only (G), middle-only (M), exit-only (E)
+    and guard+exit (D) bandwidth, solving the equations of dir-spec 3.8.3
+    (port of Tor's networkstatus_compute_bw_weights_v10). Returns None if
+    a total is 0 or no case yields valid weights, as Tor then omits them.
+    """
+
+    G, M, E, D = int(G), int(M), int(E), int(D)
+    weight_scale = int(weight_scale)
+    T = G + M + E + D
+    if (G <= 0) or (M <= 0) or (E <= 0) or (D <= 0):
+        return None
+
+    def check():
+        return _check_bw_weights(Wgg, Wgd, Wmg, Wme, Wmd, Wee, Wed,
+            weight_scale, G, M, E, D, T)
+
+    if (3*E >= T) and (3*G >= T):
+        # Case 1: neither guards nor exits are scarce
+        Wgd = Wed = Wmd = _tor_div(weight_scale, 3)
+        Wee = _tor_div(weight_scale*(E+G+M), 3*E)
+        Wme = weight_scale - Wee
+        Wmg = _tor_div(weight_scale*(2*G-E-M), 3*G)
+        Wgg = weight_scale - Wmg
+        if (check() is not None):
+            return None
+    elif (3*E < T) and (3*G < T):
+        # Case 2: both guards and exits are scarce
+        R = min(E, G)
+        S = max(E, G)
+        if (R+D < S):
+            Wgg = Wee = weight_scale
+            Wmg = Wme = Wmd = 0
+            if (E < G):
+                Wed = weight_scale
+                Wgd = 0
+            else:
+                Wed = 0
+                Wgd = weight_scale
+        else:
+            Wee = _tor_div(weight_scale*(E - G + M), E)
+            Wed = _tor_div(weight_scale*(D - 2*E + 4*G - 2*M), 3*D)
+            Wme = _tor_div(weight_scale*(G - M), E)
+            Wmg = 0
+            Wgg = weight_scale
+            Wmd = Wgd = _tor_div(weight_scale - Wed, 2)
+            error = check()
+            if (error is not None):
+                Wgg = Wee = weight_scale
+                Wed = _tor_div(weight_scale*(D - 2*E + G + M), 3*D)
+                Wmd = _tor_div(weight_scale*(D - 2*M + G + E), 3*D)
+                Wme = Wmg = 0
+                # too much middle bandwidth to balance
+                if (Wmd < 0):
+                    Wmd = 0
+                Wgd = weight_scale - Wed - Wmd
+                error = check()
+            if (error is not None) and (error != 'balance_mid'):
+                return None
+    else:
+        # Case 3: exactly one of guards or exits is scarce
+        S = min(E, G)
+        if (3*(S+D) < T):
+            if (G < E):
+                Wgg = Wgd = weight_scale
+                Wmd = Wed = Wmg = 0
+                Wme = 0 if (E < M) else _tor_div(weight_scale*(E-M), 2*E)
+                Wee = weight_scale - Wme
+            else:
+                Wee = Wed = weight_scale
+                Wmd = Wgd = Wme = 0
+                Wmg = 0 if (G < M) else _tor_div(weight_scale*(G-M), 2*G)
+                Wgg = weight_scale - Wmg
+        else:
+            if (G < E):
+                Wgg = weight_scale
+                Wgd = _tor_div(weight_scale*(D - 2*G + E + M), 3*D)
+                Wmg = 0
+                Wee = _tor_div(weight_scale*(E+M), 2*E)
+                Wme = weight_scale - Wee
+                Wmd = Wed = _tor_div(weight_scale - Wgd, 2)
+            else:
+                Wee = weight_scale
+                Wed = _tor_div(weight_scale*(D - 2*E + G + M), 3*D)
+                Wme = 0
+                Wgg = _tor_div(weight_scale*(G+M), 2*G)
+                Wmg = weight_scale - Wgg
+                Wmd = Wgd = _tor_div(weight_scale - Wed, 2)
+            if (check() is not None):
+                return None
+
+    return {'Wbd': Wmd, 'Wbe': Wme, 'Wbg': Wmg, 'Wbm': weight_scale,
+        'Wdb': weight_scale,
+        'Web': weight_scale, 'Wed': Wed, 'Wee': Wee, 'Weg': Wed, 'Wem': Wee,
+        'Wgb': weight_scale, 'Wgd': Wgd, 'Wgg': Wgg, 'Wgm': Wgg,
+        'Wmb': weight_scale, 'Wmd': Wmd, 'Wme': Wme, 'Wmg': Wmg,
+        'Wmm': weight_scale}
+
+
+# Relay classes of the bandwidth-weight equations
+BW_WEIGHT_CLASSES = ('G', 'M', 'E', 'D')
+
+def get_bw_weight_totals(flag_bitmasks, bandwidths):
+    """
+    Returns dict mapping each of BW_WEIGHT_CLASSES to the total consensus
+    bandwidth of its relays, classified as the directory authorities do:
+    BadExit relays do not count as exits, and missing bandwidths (-1)
+    count as 0. To reproduce a consensus's bandwidth-weights, pass every
+    router entry of the consensus.
+    """
+
+    bandwidths = np.maximum(np.asarray(bandwidths, dtype=np.int64), 0)
+    is_guard = (flag_bitmasks & FLAG_BITS['Guard']) != 0
+    is_exit = ((flag_bitmasks & FLAG_BITS['Exit']) != 0) & \
+        ((flag_bitmasks & FLAG_BITS['BadExit']) == 0)
+    classes = {'G': is_guard & ~is_exit, 'M': ~is_guard & ~is_exit,
+        'E': ~is_guard & is_exit, 'D': is_guard & is_exit}
+    return {c: int(bandwidths[classes[c]].sum()) for c in BW_WEIGHT_CLASSES}
+
+class BandwidthWeightEngine:
+    """
+    Recomputes consensus bandwidth weights for a network plus inserted
+    adversary relays. The per-class bandwidth totals of the base network
+    are summed once; each query adds the adversary bandwidth to them and
+    re-solves the (constant-time) dir-spec equations, so sweeps over many
+    adversary bandwidths cost one vectorized multiply per query.
+
+    The totals are those of every router in the consensus
+    (network_state.cons_bw_totals), not only the relays with descriptors
+    in cons_rel_stats, so that with no adversary the consensus's own
+    bandwidth-weights are reproduced; if verify, this is checked.
+    """
+
+    def __init__(self, network_state, verify=True):
+        fingerprints, flag_bitmasks, bandwidths = \
+            get_relay_arrays(network_state)
+        self.fingerprints = fingerprints
+        self.bandwidths = np.maximum(bandwidths, 0)
+        self.weight_scale = network_state.cons_bwweightscale
+        self.guard_mask = get_guard_mask(flag_bitmasks)
+        # authorities do not count BadExit relays as exits
+        self.is_exit = ((flag_bitmasks & FLAG_BITS['Exit']) != 0) & \
+            ((flag_bitmasks & FLAG_BITS['BadExit']) == 0)
+
+        totals = getattr(network_state, 'cons_bw_totals', None)
+        if (totals is None):
+            # e.g. snapshots written before the totals were recorded
+            print('Warning: consensus bandwidth totals unknown, using the '
+                'relays with descriptors only')
+            totals = get_bw_weight_totals(flag_bitmasks, bandwidths)
+            verify = False
+        self.totals = dict(totals)
+
+        if verify:
+            mismatched = self.check_consensus_weights(
+                network_state.cons_bw_weights)
+            if mismatched:
+                raise ValueError('Recomputed bandwidth weights differ from '
+                    'the consensus: {0}'.format(', '.join(mismatched)))
+
+    def check_consensus_weights(self, cons_bw_weights, tolerance=1):
+        """
+        Returns sorted list of the bandwidth weights that, recomputed with
+        no adversary, differ from cons_bw_weights by more than tolerance
+        (rounding). Empty if they match or the consensus has none.
+        """
+
+        if not cons_bw_weights:
+            return []
+        bw_weights = self.get_bw_weights()
+        if (bw_weights is None):
+            return sorted(cons_bw_weights)
+        return sorted(key for key, value in cons_bw_weights.items()
+            if (key in bw_weights) and
+            (abs(bw_weights[key] - value) > tolerance))
+
+    def get_bw_weights(self, adversary_bandwidths=(), adversary_class='G'):
+        """
+        Returns bandwidth-weights dict (see compute_bw_weights) after adding
+        relays with the given consensus bandwidths to adversary_class
+        ('G' guard only, 'M', 'E' or 'D' guard and exit).
+        """
+
+        if adversary_class not in BW_WEIGHT_CLASSES:
+            raise ValueError('Unknown bandwidth weight class {0}.'.format(
+                adversary_class))
+        totals = dict(self.totals)
+        totals[adversary_class] += int(np.sum(adversary_bandwidths))
+        return compute_bw_weights(totals['G'], totals['M'], totals['E'],
+            totals['D'], self.weight_scale)
+
+    def get_guard_weights(self, adversary_bandwidths=(), adversary_class='G'):
+        """
+        Returns (guard weights of the base network's guards, in
+        get_relay_arrays order with 0 for non-guards, guard weights of the
+        adversary relays) under the recomputed bandwidth weights.
+        """
+
+        bw_weights = self.get_bw_weights(adversary_bandwidths, adversary_class)
+        if (bw_weights is None):
+            raise ValueError('No valid bandwidth weights for this network.')
+        scale = float(self.weight_scale)
+        weights = np.where(self.is_exit, bw_weights['Wgd'],
+            bw_weights['Wgg']) / scale
+        guard_weights = np.where(self.guard_mask, self.bandwidths * weights, 0.0)
+
+        # only guard-flagged adversary relays get guard weight
+        adversary_weight = {'G': bw_weights['Wgg'], 'D': bw_weights['Wgd']}.\
+            get(adversary_class, 0)
+        adversary_weights = np.asarray(adversary_bandwidths,
+            dtype=np.float64) * (adversary_weight / scale)
+        return guard_weights, adversary_weights
+
+
+class NetworkStateDiff:
+    """
+    Relays that joined, left, or changed consensus bandwidth or flags
+    between two network states, each as a sorted numpy array of
+    fingerprints.
+    """
+
+    def __init__(self, joined, left, bandwidth_changed, flags_changed):
+        self.joined = joined
+        self.left = left
+        self.bandwidth_changed = bandwidth_changed
+        self.flags_changed = flags_changed
+
+
+def diff_network_states(old_network_state, new_network_state):
+    """
+    Returns NetworkStateDiff between the relays of two network states,
+    computed from their fingerprint arrays sorted once (snapshot columns
+    are already sorted).
+    """
+
+    old_fps, old_flags, old_bws = get_relay_arrays(old_network_state)
+    new_fps, new_flags, new_bws = get_relay_arrays(new_network_state)
+    old_order = np.argsort(old_fps)
+    new_order = np.argsort(new_fps)
+    old_fps = old_fps[old_order]
+    new_fps = new_fps[new_order]
+
+    common, old_idx, new_idx = np.intersect1d(old_fps, new_fps,
+        assume_unique=True, return_indices=True)
+    old_idx = old_order[old_idx]
+    new_idx = new_order[new_idx]
+
+    return NetworkStateDiff(
+        np.setdiff1d(new_fps, old_fps, assume_unique=True),
+        np.setdiff1d(old_fps, new_fps, assume_unique=True),
+        common[old_bws[old_idx] != new_bws[new_idx]],
+        common[old_flags[old_idx] != new_flags[new_idx]])
+
+
+def _subnet_key(address):
+    """
+    Returns hashable key of the subnet Tor refuses to use twice in a path:
+    the /16 for IPv4 addresses and the /32 for IPv6 addresses.
+    """
+
+    ip = ipaddress.ip_address(address)
+    prefix = 16 if (ip.version == 4) else 32
+    return (ip.version, int(ip) >> (ip.max_prefixlen - prefix))
+
+
+def _family_entry_fingerprint(entry):
+    """Returns fingerprint of a '$FP', '$FP=nick' or '$FP~nick' family entry,
+    or None for nickname entries."""
+
+    if not entry.startswith('$'):
+        return None
+    return re.split('[=~]', entry[1:], 1)[0].upper()
+
+
+class GuardConflictIndex:
+    """
+    Precomputed /16-subnet and family groups for a list of relays, used to
+    apply the client-specific path constraints that get_guard_list omits.
+
+    Relays are grouped by subnet via hashing, and by family via union-find
+    over mutual family declarations (both relays must list each other, by
+    fingerprint or nickname). Union-find makes families transitive, which
+    can only make the index more conservative than Tor's pairwise check.
+    Same-IP conflicts are covered by the subnet groups.
+
+    The members of every group are also precomputed, so a query against a
+    chosen set costs a dict lookup per chosen relay plus a union of their
+    (small) groups, independent of the number of relays indexed.
+    """
+
+    def __init__(self, relay_list, descriptors=None):
+        """
+        relay_list:  relays with fingerprint and address attributes
+                     (consensus entries, RelayRecord or GuardRecord)
+        descriptors: dict mapping fingerprint to server descriptor; only
+                     descriptors with a family attribute (stem descriptors,
+                     or DescriptorRecords from parse_descriptors_trusted)
+                     contribute to family groups
+        """
+
+        self.fingerprints = [relay.fingerprint for relay in relay_list]
+        self.index = {fp: i for i, fp in enumerate(self.fingerprints)}
+
+        subnet_ids = {}
+        self.subnet = np.fromiter((subnet_ids.setdefault(
+            _subnet_key(relay.address), len(subnet_ids))
+            for relay in relay_list), dtype=np.int64,
+            count=len(self.fingerprints))
+
+        parent = list(range(len(self.fingerprints)))
+        if descriptors is not None:
+            self._union_families(parent, relay_list, descriptors)
+        self.family = np.array([self._find(parent, i)
+            for i in range(len(parent))], dtype=np.int64)
+
+        self.subnet_members = self._group_members(self.subnet)
+        self.family_members = self._group_members(self.family)
+
+    @staticmethod
+    def _group_members(group_ids):
+        """Returns dict mapping group id to numpy array of its rows."""
+
+        order = np.argsort(group_ids, kind='stable')
+        ids, starts = np.unique(group_ids[order], return_index=True)
+        return dict(zip(ids.tolist(), np.split(order, starts[1:])))
+
+    def _union_families(self, parent, relay_list, descriptors):
+        """Unions the family sets of relays that list each other."""
+
+        nickname_to_indices = {}
+        for i, relay in enumerate(relay_list):
+            nickname = getattr(relay, 'nickname', None)
+            if nickname is not None:
+                nickname_to_indices.setdefault(nickname, []).append(i)
+
+        declared = set()
+        for i, fp in enumerate(self.fingerprints):
+            family = getattr(descriptors.get(fp), 'family', None)
+            if not family:
+                continue
+            for entry in family:
+                member_fp = _family_entry_fingerprint(entry)
+                if member_fp is None:
+                    members = nickname_to_indices.get(entry, ())
+                else:
+                    member = self.index.get(member_fp)
+                    members = () if (member is None) else (member,)
+                for j in members:
+                    if (j != i):
+                        declared.add((i, j))
+
+        for i, j in declared:
+            if (j, i) in declared:
+                root_i = self._find(parent, i)
+                root_j = self._find(parent, j)
+                if (root_i != root_j):
+                    parent[root_j] = root_i
+
+    @staticmethod
+    def _find(parent, i):
+        while (parent[i] != i):
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def _chosen_groups(self, chosen):
+        """Returns (subnet ids, family ids) of the chosen fingerprints."""
+
+        rows = [self.index[fp] for fp in chosen]
+        return set(self.subnet[rows].tolist()), set(self.family[rows].tolist())
+
+    def get_conflicting_rows(self, chosen):
+        """
+        Returns sorted numpy array of the rows of relays that conflict with
+        at least one fingerprint in chosen (including the chosen relays),
+        built from the precomputed groups without scanning all relays.
+        """
+
+        subnets, families = self._chosen_groups(chosen)
+        groups = [self.subnet_members[s] for s in subnets] + \
+            [self.family_members[f] for f in families]
+        if not groups:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(groups))
+
+    def get_conflicting_guards(self, chosen):
+        """Returns fingerprints of relays conflicting with the chosen set."""
+
+        return [self.fingerprints[i]
+                for i in self.get_conflicting_rows(chosen).tolist()]
+
+    def conflicts(self, fp1, fp2):
+        """Returns True if the two relays share a subnet or a family."""
+
+        i = self.index[fp1]
+        j = self.index[fp2]
+        return (self.subnet[i] == self.subnet[j]) or \
+            (self.family[i] == self.family[j])
+
+    def is_compatible(self, fp, chosen):
+        """
+        Returns True if relay fp conflicts with none of the fingerprints in
+        chosen. For repeated queries against the same chosen set, use
+        get_conflicting_rows or get_compatible_mask instead.
+        """
+
+        subnets, families = self._chosen_groups(chosen)
+        i = self.index[fp]
+        return (int(self.subnet[i]) not in subnets) and \
+            (int(self.family[i]) not in families)
+
+    def get_compatible_mask(self, chosen):
+        """
+        Returns boolean numpy array, aligned with self.fingerprints, that is
+        True for relays compatible with every fingerprint in chosen. The
+        conflicts are found by group lookup; only filling the returned mask
+        is linear in the number of relays.
+        """
+
+        mask = np.ones(len(self.fingerprints), dtype=bool)
+        mask[self.get_conflicting_rows(chosen)] = False
+        return mask
+
+    def get_compatible_guards(self, chosen):
+        """Returns fingerprints of relays compatible with the chosen set."""
+
+        mask = self.get_compatible_mask(chosen)
+        return [self.fingerprints[i] for i in np.flatnonzero(mask)]
+
+
+def parse_descriptor(desc_str):
+    """Returns stem server descriptor parsed from the raw text of a single
+    descriptor (as stored in fat network state files)."""
+    import stem.descriptor
+
+    descriptor = None
+    i = 0
+    for desc in stem.descriptor.parse_file(BytesIO(desc_str), validate = True):
+        if (i > 0):
+            raise ValueError('Unexpectedly found more than one descriptor in dict entry')
+        descriptor = desc
+        i += 1
+    if (descriptor is None):
+        raise ValueError('Unexpectedly found no descriptor in dict entry')
+    return descriptor
+
+
+def _parse_descriptor_shard(shard):
+    """Parses a list of (fprint, desc_str) pairs in a worker process."""
+    return [(fprint, parse_descriptor(desc_str)) for fprint, desc_str in shard]
+
+
+def parse_descriptors(raw_descriptors, workers=None):
+    """
+    Returns dict mapping fingerprint to stem server descriptor for each raw
+    descriptor in raw_descriptors. If workers > 1, contiguous shards of the
+    dict are parsed in a pool of that many processes. Either way the result
+    is identical, including key order.
+    """
+
+    if (workers is None) or (workers < 2) or (len(raw_descriptors) == 0):
+        return {fprint: parse_descriptor(desc_str)
+            for fprint, desc_str in raw_descriptors.items()}
+
+    items = list(raw_descriptors.items())
+    # a few shards per worker so that uneven shards even out
+    num_shards = min(len(items), 4 * workers)
+    shard_size = -(-len(items) // num_shards)
+    shards = [items[i:i+shard_size] for i in range(0, len(items), shard_size)]
+    with multiprocessing.Pool(workers) as pool:
+        parsed_shards = pool.map(_parse_descriptor_shard, shards)
+
+    descriptors = {}
+    for parsed_shard in parsed_shards:
+        descriptors.update(parsed_shard)
+    return descriptors
+
+
+class LazyDescriptors(Mapping):
+    """
+    Mapping from fingerprint to stem server descriptor that keeps the raw
+    descriptor text and parses an entry only the first time it is accessed.
+    Membership tests and iteration never parse.
+    """
+
+    def __init__(self, raw_descriptors):
+        self._raw_descriptors = raw_descriptors
+        self._parsed = {}
+
+    def __getitem__(self, fprint):
+        desc = self._parsed.get(fprint)
+        if desc is None:
+            desc = parse_descriptor(self._raw_descriptors[fprint])
+            self._parsed[fprint] = desc
+        return desc
+
+    def __contains__(self, fprint):
+        return fprint in self._raw_descriptors
+
+    def __iter__(self):
+        return iter(self._raw_descriptors)
+
+    def __len__(self):
+        return len(self._raw_descriptors)
+
+
+# Openers for compressed network state files, and the magic bytes each
+# format starts with (pickles start with b'\x80', so these cannot clash)
+NETWORK_STATE_COMPRESSIONS = {'lzma': lzma.open, 'gzip': gzip.open,
+    'bz2': bz2.open}
+_COMPRESSION_MAGIC = [(b'\xfd7zXZ\x00', 'lzma'), (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2')]
+
+def detect_compression(filename):
+    """Returns compression format of filename as a key of
+    NETWORK_STATE_COMPRESSIONS, or None if it is not compressed."""
+    with open(filename, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in _COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+def open_network_state(filename, mode='rb', compression=None):
+    """Opens network state file as a binary file object. When reading,
+    compression is detected from the file contents and the file is
+    decompressed as it is read. When writing, compression is one of
+    NETWORK_STATE_COMPRESSIONS or None for an uncompressed file."""
+    if ('r' in mode):
+        compression = detect_compression(filename)
+    if (compression is None):
+        return open(filename, mode)
+    if (compression not in NETWORK_STATE_COMPRESSIONS):
+        raise ValueError('Unknown network state compression: {0}'.format(
+            compression))
+    return NETWORK_STATE_COMPRESSIONS[compression](filename, mode)
+
+def _as_bytes(s):
+    """Returns s encoded as UTF-8 if it is a str (as pickled by
+    process_consensus under Python 3), otherwise s."""
+    if isinstance(s, str):
+        return s.encode('utf-8')
+    return s
 
 
 # Modified from tempest relays.py
-def tempest_fat_network_state(ns_filename):
+def tempest_fat_network_state(ns_filename, lazy=False, workers=None,
+    trusted=False, verify_sample=0):
     """Reading fat network state file into commonly-used variables.
-    Cannot use pathsim.get_network_state() because nsf is fat."""
+    Cannot use pathsim.get_network_state() because nsf is fat.
+    If lazy, descriptors is a LazyDescriptors mapping that parses each
+    descriptor on first access instead of all of them up front.
+    If workers > 1, descriptors are parsed in a pool of that many processes.
+    If trusted, the consensus and descriptors are read by
+    parse_consensus_trusted and parse_descriptors_trusted (each checking
+    verify_sample entries against stem), cons_rel_stats holds RelayRecords
+    and descriptors holds DescriptorRecords (lazy and workers are unused).
+    Compressed network state files (see open_network_state) are
+    decompressed while they are read."""
+    if lazy and (workers is not None) and (workers > 1):
+        raise ValueError('lazy and workers cannot be combined')
     cons_rel_stats = {}
-    with open(ns_filename, 'rb') as nsf:
-        consensus_str = pickle.load(nsf, encoding='bytes')
-        # convert consensus from string to stem object
-        i = 0
-        for doc in stem.descriptor.parse_file(BytesIO(consensus_str),
-                                              validate=True,
-                                              document_handler='DOCUMENT'):
-            if (i > 0):
-                raise ValueError('Unexpectedly found more than one consensus in network state file')
-            consensus = doc
-            i += 1
-        # convert descriptors from strings to stem objets
-        descriptors = pickle.load(nsf, encoding='bytes')
-        for fprint, desc_str in descriptors.items():
+    with open_network_state(ns_filename) as nsf:
+        consensus_str = _as_bytes(pickle.load(nsf, encoding='bytes'))
+        if trusted:
+            consensus = parse_consensus_trusted(consensus_str, verify_sample)
+        else:
+            # convert consensus from string to stem object
+            import stem.descriptor
             i = 0
-            for desc in stem.descriptor.parse_file(BytesIO(desc_str), validate = True):
+            for doc in stem.descriptor.parse_file(BytesIO(consensus_str),
+                                                  validate=True,
+                                                  document_handler='DOCUMENT'):
                 if (i > 0):
-                    raise ValueError('Unexpectedly found more than one descriptor in dict entry')
-                descriptors[fprint] = desc
+                    raise ValueError('Unexpectedly found more than one consensus in network state file')
+                consensus = doc
                 i += 1
+        raw_descriptors = pickle.load(nsf, encoding='bytes')
         hibernating_statuses = pickle.load(nsf, encoding='bytes')
 
     # descriptor conversion
     converted_descriptors = {}
-    for fprint, descriptor in descriptors.items():
-        converted_descriptors[fprint.decode('utf-8')] = descriptor
+    for fprint, desc_str in raw_descriptors.items():
+        if isinstance(fprint, bytes):
+            fprint = fprint.decode('utf-8')
+        converted_descriptors[fprint] = _as_bytes(desc_str)
 
-    descriptors = converted_descriptors
+    if trusted:
+        descriptors = parse_descriptors_trusted(
+            b'\n'.join(converted_descriptors.values()), verify_sample).records()
+    elif lazy:
+        descriptors = LazyDescriptors(converted_descriptors)
+    else:
+        # convert descriptors from strings to stem objets
+        descriptors = parse_descriptors(converted_descriptors, workers)
 
     # set variables from consensus
     cons_valid_after = pathsim_timestamp(consensus.valid_after)
@@ -159,97 +1136,766 @@ def tempest_fat_network_state(ns_filename):
         if (relay_fprint in descriptors):
             cons_rel_stats[relay_fprint] = consensus.routers[relay_fprint]
 
-    return NetworkState(cons_rel_stats, descriptors, cons_valid_after, cons_fresh_until, cons_bw_weights, cons_bwweightscale)
+    # bandwidth-weight totals are over every router in the consensus
+    if trusted:
+        cons_bw_totals = get_bw_weight_totals(consensus.flags,
+            consensus.bandwidth)
+    else:
+        routers = list(consensus.routers.values())
+        cons_bw_totals = get_bw_weight_totals(get_flag_bitmasks(routers),
+            np.fromiter((-1 if router.bandwidth is None else
+            router.bandwidth for router in routers), dtype=np.int64,
+            count=len(routers)))
+
+    relay_columns = None
+    if trusted:
+        # consensus columns restricted to relays in cons_rel_stats
+        in_network = np.fromiter((fprint in descriptors
+            for fprint in consensus.fingerprints), dtype=bool,
+            count=len(consensus.fingerprints))
+        relay_columns = {
+            'fingerprint': np.array(consensus.fingerprints,
+                dtype='U40')[in_network],
+            'flags': consensus.flags[in_network],
+            'bandwidth': consensus.bandwidth[in_network]}
+
+    return NetworkState(cons_rel_stats, descriptors, cons_valid_after,
+        cons_fresh_until, cons_bw_weights, cons_bwweightscale,
+        relay_columns=relay_columns,
+        hibernation=get_hibernation_timeline(hibernating_statuses),
+        cons_bw_totals=cons_bw_totals)
+
+
+def get_network_state_filenames(directory, suffix='-network_state'):
+    """
+    Returns sorted paths of the network state files in directory. File
+    names start with the consensus valid-after time, so this is also
+    chronological order.
+    """
+
+    return sorted(os.path.join(directory, filename)
+        for filename in os.listdir(directory) if filename.endswith(suffix))
+
+
+def iter_network_states(directory, prefetch=2, processes=False,
+    suffix='-network_state', **kwargs):
+    """
+    Yields (filename, NetworkState) for each network state file in
+    directory, in chronological order. While the caller works on one
+    network state, up to prefetch following files are read and decoded
+    in background threads (or processes if processes is True), so at most
+    prefetch + 1 network states are held at once. prefetch=0 reads each
+    file only when it is reached. Other keyword arguments are passed to
+    tempest_fat_network_state (workers cannot be used with processes).
+    """
+
+    filenames = iter(get_network_state_filenames(directory, suffix))
+    if (prefetch < 1):
+        for filename in filenames:
+            yield filename, tempest_fat_network_state(filename, **kwargs)
+        return
+
+    if processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=prefetch)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch)
+    pending = deque()
+    try:
+        for filename in itertools.islice(filenames, prefetch):
+            pending.append((filename, executor.submit(
+                tempest_fat_network_state, filename, **kwargs)))
+        while pending:
+            filename, future = pending.popleft()
+            network_state = future.result()
+            # keep prefetch files in flight while the caller works
+            for next_filename in itertools.islice(filenames, 1):
+                pending.append((next_filename, executor.submit(
+                    tempest_fat_network_state, next_filename, **kwargs)))
+            yield filename, network_state
+    finally:
+        for filename, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _parse_datetime(date, time):
+    """Returns datetime for b'YYYY-MM-DD', b'HH:MM:SS' consensus fields."""
+    return datetime.datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+        int(time[0:2]), int(time[3:5]), int(time[6:8]))
+
+
+def _parse_int_mapping(fields):
+    """Returns dict for b'key=value' fields with integer values."""
+    mapping = {}
+    for field in fields:
+        key, _, value = field.partition(b'=')
+        mapping[key.decode('ascii')] = int(value)
+    return mapping
+
+
+class TrustedConsensus:
+    """
+    Consensus read by parse_consensus_trusted. Per-relay fields are kept as
+    parallel columns in document order: fingerprints, nicknames and
+    addresses are lists, flags (bitmask), bandwidth (-1 if absent) and
+    published (UNIX timestamp) are numpy arrays.
+
+    Provides the NetworkStatusDocumentV3 attributes used in this project
+    (valid_after, fresh_until, params, bandwidth_weights, routers, str()).
+    """
+
+    def __init__(self, contents, valid_after, fresh_until, params,
+        bandwidth_weights, fingerprints, nicknames, addresses, flags,
+        bandwidth, published):
+        self._contents = contents
+        self.valid_after = valid_after
+        self.fresh_until = fresh_until
+        self.params = params
+        self.bandwidth_weights = bandwidth_weights
+        self.fingerprints = fingerprints
+        self.nicknames = nicknames
+        self.addresses = addresses
+        self.flags = flags
+        self.bandwidth = bandwidth
+        self.published = published
+        self._routers = None
+
+    @property
+    def routers(self):
+        """Dict mapping fingerprint to RelayRecord, in document order."""
+        if self._routers is None:
+            routers = {}
+            for i, fprint in enumerate(self.fingerprints):
+                bandwidth = int(self.bandwidth[i])
+                routers[fprint] = RelayRecord(fprint, self.addresses[i],
+                    bitmask_to_flags(int(self.flags[i])),
+                    None if bandwidth < 0 else bandwidth,
+                    nickname=self.nicknames[i],
+                    published=datetime.datetime(1970, 1, 1) +
+                        datetime.timedelta(seconds=int(self.published[i])))
+            self._routers = routers
+        return self._routers
+
+    def __str__(self):
+        return self._contents.decode('utf-8')
+
+
+def parse_consensus_trusted(consensus_bytes, verify_sample=0, seed=None):
+    """
+    Returns TrustedConsensus read from the raw text of a network status
+    consensus with a single line scan, bypassing stem's validating parser.
+    Only use on consensuses from a trusted source such as CollecTor.
+
+    If verify_sample > 0, the header, footer and that many randomly chosen
+    router entries are also parsed by stem and compared, raising
+    ValueError on any mismatch.
+    """
+
+    # skip metrics type annotations
+    start = 0
+    while consensus_bytes.startswith(b'@', start):
+        start = consensus_bytes.index(b'\n', start) + 1
+    contents = consensus_bytes[start:]
+
+    valid_after = None
+    fresh_until = None
+    params = {}
+    bandwidth_weights = {}
+    fingerprints = []
+    nicknames = []
+    addresses = []
+    flags = array('L')
+    bandwidth = array('q')
+    published = array('q')
+    entry_starts = []
+    footer_start = len(contents)
+
+    pos = 0
+    end = len(contents)
+    while pos < end:
+        line_start = pos
+        pos = contents.find(b'\n', pos)
+        if (pos == -1):
+            pos = end
+        line = contents[line_start:pos]
+        pos += 1
+
+        keyword, _, rest = line.partition(b' ')
+        if (keyword == b'r'):
+            fields = rest.split()
+            # microdescriptor consensuses omit the descriptor digest
+            if (len(fields) >= 8):
+                date, time, address = fields[3], fields[4], fields[5]
+            else:
+                date, time, address = fields[2], fields[3], fields[4]
+            identity = fields[1]
+            identity += b'=' * (-len(identity) % 4)
+            fingerprints.append(binascii.hexlify(
+                base64.b64decode(identity)).decode('ascii').upper())
+            nicknames.append(fields[0].decode('utf-8'))
+            addresses.append(address.decode('ascii'))
+            flags.append(0)
+            bandwidth.append(-1)
+            published.append(pathsim_timestamp(_parse_datetime(date, time)))
+            entry_starts.append(line_start)
+        elif (keyword == b's'):
+            flags[-1] = flags_to_bitmask(rest.decode('ascii').split())
+        elif (keyword == b'w'):
+            for field in rest.split():
+                if field.startswith(b'Bandwidth='):
+                    bandwidth[-1] = int(field[10:])
+        elif (keyword == b'valid-after'):
+            valid_after = _parse_datetime(*rest.split())
+        elif (keyword == b'fresh-until'):
+            fresh_until = _parse_datetime(*rest.split())
+        elif (keyword == b'params'):
+            params = _parse_int_mapping(rest.split())
+        elif (keyword == b'directory-footer'):
+            footer_start = line_start
+        elif (keyword == b'bandwidth-weights'):
+            bandwidth_weights = _parse_int_mapping(rest.split())
+        elif (keyword == b'directory-signature'):
+            # only signatures follow
+            break
+
+    if (valid_after is None) or (fresh_until is None):
+        raise ValueError('Consensus is missing valid-after or fresh-until')
+
+    consensus = TrustedConsensus(contents, valid_after, fresh_until, params,
+        bandwidth_weights, fingerprints, nicknames, addresses,
+        np.array(flags, dtype=np.uint32), np.array(bandwidth, dtype=np.int64),
+        np.array(published, dtype=np.int64))
+
+    if (verify_sample > 0):
+        entry_starts.append(footer_start)
+        verify_consensus_trusted(consensus, contents, entry_starts,
+            verify_sample, seed)
+
+    return consensus
+
+
+def verify_consensus_trusted(consensus, contents, entry_starts, sample_size,
+    seed=None):
+    """
+    Compares the header, footer and sample_size random router entries of a
+    TrustedConsensus against stem's validating parser. entry_starts holds
+    the offset of each router entry in contents, followed by the offset of
+    the footer. Raises ValueError on the first mismatch.
+    """
+    from stem.descriptor.networkstatus import NetworkStatusDocumentV3
+    from stem.descriptor.router_status_entry import RouterStatusEntryV3
+
+    num_relays = len(consensus.fingerprints)
+    if (num_relays > 0):
+        skeleton = contents[:entry_starts[0]] + contents[entry_starts[-1]:]
+    else:
+        skeleton = contents
+    document = NetworkStatusDocumentV3(skeleton, validate=True)
+    for attr in ('valid_after', 'fresh_until', 'params', 'bandwidth_weights'):
+        if (getattr(document, attr) != getattr(consensus, attr)):
+            raise ValueError('Trusted parser mismatch on {0}: {1} != {2}'.\
+                format(attr, getattr(consensus, attr), getattr(document, attr)))
+
+    rng = random.Random(seed)
+    for i in rng.sample(range(num_relays), min(sample_size, num_relays)):
+        entry = RouterStatusEntryV3(contents[entry_starts[i]:entry_starts[i+1]],
+            validate=True)
+        bandwidth = int(consensus.bandwidth[i])
+        expected = (entry.fingerprint, entry.nickname, entry.address,
+            flags_to_bitmask(entry.flags), entry.bandwidth,
+            pathsim_timestamp(entry.published))
+        found = (consensus.fingerprints[i], consensus.nicknames[i],
+            consensus.addresses[i], int(consensus.flags[i]),
+            None if bandwidth < 0 else bandwidth, int(consensus.published[i]))
+        if (expected != found):
+            raise ValueError('Trusted parser mismatch on router entry {0}: {1} != {2}'.\
+                format(i, found, expected))
 
 
-def get_real_bw(bandwidth_weight):
+class TrustedDescriptors:
+    """
+    Server descriptors read by parse_descriptors_trusted, as parallel
+    columns in document order: fingerprints, nicknames, addresses and
+    families (sets of family entries) are lists, published (UNIX
+    timestamp), hibernating, average_bandwidth and observed_bandwidth are
+    numpy arrays. starts and ends give the span of each descriptor's text,
+    from its router line through its signature, in contents.
+    """
+
+    def __init__(self, contents, starts, ends, fingerprints, nicknames,
+        addresses, published, hibernating, families, average_bandwidth,
+        observed_bandwidth):
+        self._contents = contents
+        self.starts = starts
+        self.ends = ends
+        self.fingerprints = fingerprints
+        self.nicknames = nicknames
+        self.addresses = addresses
+        self.published = published
+        self.hibernating = hibernating
+        self.families = families
+        self.average_bandwidth = average_bandwidth
+        self.observed_bandwidth = observed_bandwidth
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def get_bytes(self, i):
+        """Returns the text of descriptor i, as stem's get_bytes()."""
+        return self._contents[self.starts[i]:self.ends[i]]
+
+    def records(self):
+        """Returns dict mapping fingerprint to DescriptorRecord."""
+        return {fprint: DescriptorRecord(fprint, self.addresses[i],
+            int(self.average_bandwidth[i]), int(self.observed_bandwidth[i]),
+            published=datetime.datetime(1970, 1, 1) +
+                datetime.timedelta(seconds=int(self.published[i])),
+            hibernating=bool(self.hibernating[i]), family=self.families[i])
+            for i, fprint in enumerate(self.fingerprints)}
+
+
+def parse_descriptors_trusted(descriptor_bytes, verify_sample=0, seed=None):
+    """
+    Returns TrustedDescriptors read from the raw text of one or more server
+    descriptors with a single line scan, bypassing stem's validating
+    parser. Only the fields used in this project are extracted. Only use on
+    descriptors from a trusted source such as CollecTor.
+
+    If verify_sample > 0, that many randomly chosen descriptors are also
+    parsed by stem and compared, raising ValueError on any mismatch.
+    """
+
+    starts = array('q')
+    ends = array('q')
+    fingerprints = []
+    nicknames = []
+    addresses = []
+    published = array('q')
+    hibernating = array('b')
+    families = []
+    average_bandwidth = array('q')
+    observed_bandwidth = array('q')
+
+    in_descriptor = False
+    in_signature = False
+    pos = 0
+    end = len(descriptor_bytes)
+    while pos < end:
+        line_start = pos
+        pos = descriptor_bytes.find(b'\n', pos)
+        if (pos == -1):
+            pos = end
+        line = descriptor_bytes[line_start:pos]
+        pos += 1
+
+        if in_signature:
+            if line.startswith(b'-----END'):
+                ends.append(min(pos, end))
+                in_descriptor = False
+                in_signature = False
+            continue
+
+        keyword, _, rest = line.partition(b' ')
+        if not in_descriptor:
+            # anything before a router line is an annotation
+            if (keyword == b'router'):
+                fields = rest.split()
+                starts.append(line_start)
+                fingerprints.append(None)
+                nicknames.append(fields[0].decode('utf-8'))
+                addresses.append(fields[1].decode('ascii'))
+                published.append(0)
+                hibernating.append(False)
+                families.append(set())
+                average_bandwidth.append(0)
+                observed_bandwidth.append(0)
+                in_descriptor = True
+        elif (keyword == b'published'):
+            published[-1] = pathsim_timestamp(_parse_datetime(*rest.split()))
+        elif (keyword == b'fingerprint'):
+            fingerprints[-1] = rest.replace(b' ', b'').decode('ascii')
+        elif (keyword == b'bandwidth'):
+            fields = rest.split()
+            average_bandwidth[-1] = int(fields[0])
+            observed_bandwidth[-1] = int(fields[2])
+        elif (keyword == b'hibernating'):
+            hibernating[-1] = (rest == b'1')
+        elif (keyword == b'family'):
+            families[-1] = set(rest.decode('utf-8').split())
+        elif (keyword == b'router-signature'):
+            in_signature = True
+
+    if in_descriptor:
+        raise ValueError('Descriptor of {0} ends before its signature'.format(
+            nicknames[-1]))
+
+    descriptors = TrustedDescriptors(descriptor_bytes, starts, ends,
+        fingerprints, nicknames, addresses, np.array(published, dtype=np.int64),
+        np.array(hibernating, dtype=bool), families,
+        np.array(average_bandwidth, dtype=np.int64),
+        np.array(observed_bandwidth, dtype=np.int64))
+
+    if (verify_sample > 0):
+        verify_descriptors_trusted(descriptors, verify_sample, seed)
+
+    return descriptors
+
+
+def verify_descriptors_trusted(descriptors, sample_size, seed=None):
+    """
+    Compares sample_size random descriptors of a TrustedDescriptors, and
+    their text spans, against stem's validating parser. Raises ValueError
+    on the first mismatch.
+    """
+    from stem.descriptor.server_descriptor import RelayDescriptor
+
+    rng = random.Random(seed)
+    num_descriptors = len(descriptors)
+    for i in rng.sample(range(num_descriptors),
+        min(sample_size, num_descriptors)):
+        desc = RelayDescriptor(descriptors.get_bytes(i), validate=True)
+        if (desc.get_bytes() != descriptors.get_bytes(i)):
+            raise ValueError('Trusted parser mismatch on text of descriptor {0}'.\
+                format(i))
+        expected = (desc.fingerprint, desc.nickname, desc.address,
+            pathsim_timestamp(desc.published), desc.hibernating, desc.family,
+            desc.average_bandwidth, desc.observed_bandwidth)
+        found = (descriptors.fingerprints[i], descriptors.nicknames[i],
+            descriptors.addresses[i], int(descriptors.published[i]),
+            bool(descriptors.hibernating[i]), descriptors.families[i],
+            int(descriptors.average_bandwidth[i]),
+            int(descriptors.observed_bandwidth[i]))
+        if (expected != found):
+            raise ValueError('Trusted parser mismatch on descriptor {0}: {1} != {2}'.\
+                format(i, found, expected))
+
+
+def _snapshot_align(n):
+    return -(-n // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+
+
+def write_network_state_snapshot(network_state, snapshot_filename):
+    """
+    Writes the fields of network_state used by the analyses to a columnar
+    snapshot file, one fixed-width column per field with relays sorted by
+    fingerprint. Relays without a descriptor are omitted.
+
+    Layout: magic, header length (uint64), JSON header, then the columns,
+    each aligned to SNAPSHOT_ALIGNMENT bytes.
+    """
+
+    cons_rel_stats = network_state.cons_rel_stats
+    descriptors = network_state.descriptors
+    fprints = sorted(fp for fp in cons_rel_stats if fp in descriptors)
+
+    def bandwidth_or_missing(bw):
+        return -1 if bw is None else bw
+
+    columns = [
+        ('fingerprint', np.array([fp.encode('ascii') for fp in fprints],
+            dtype='S40')),
+        ('address', np.array([int(ipaddress.IPv4Address(
+            cons_rel_stats[fp].address)) for fp in fprints], dtype='<u4')),
+        ('flags', np.array([flags_to_bitmask(cons_rel_stats[fp].flags)
+            for fp in fprints], dtype='<u4')),
+        ('bandwidth', np.array([bandwidth_or_missing(
+            cons_rel_stats[fp].bandwidth) for fp in fprints], dtype='<i8')),
+        ('average_bandwidth', np.array([descriptors[fp].average_bandwidth
+            for fp in fprints], dtype='<i8')),
+        ('observed_bandwidth', np.array([descriptors[fp].observed_bandwidth
+            for fp in fprints], dtype='<i8')),
+    ]
+
+    hibernation = network_state.hibernation
+    if (hibernation is not None) and (len(fprints) > 0):
+        # hibernation relays are stored as snapshot rows
+        row_fprints = np.array(fprints, dtype='U40')
+        rows = np.minimum(np.searchsorted(row_fprints,
+            hibernation.fingerprints), len(fprints) - 1)
+        in_snapshot = (row_fprints[rows] == hibernation.fingerprints)[
+            hibernation.relays]
+        columns += [
+            ('hibernation_time', hibernation.times[in_snapshot].astype('<i8')),
+            ('hibernation_relay', rows[hibernation.relays][in_snapshot].astype(
+                '<i8')),
+            ('hibernation_state', hibernation.states[in_snapshot]),
+        ]
+
+    column_info = []
+    offset = 0
+    for name, column in columns:
+        column_info.append([name, column.dtype.str, offset, len(column)])
+        offset = _snapshot_align(offset + column.nbytes)
+
+    header = json.dumps({
+        'num_relays': len(fprints),
+        'valid_after': network_state.cons_valid_after,
+        'fresh_until': network_state.cons_fresh_until,
+        'bw_weights': dict(network_state.cons_bw_weights),
+        'bwweightscale': network_state.cons_bwweightscale,
+        'bw_totals': getattr(network_state, 'cons_bw_totals', None),
+        'flags': RELAY_FLAGS,
+        'columns': column_info}).encode('utf-8')
+    data_start = _snapshot_align(len(SNAPSHOT_MAGIC) + 8 + len(header))
+
+    with open(snapshot_filename, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for (name, column), (_, _, offset, _) in zip(columns, column_info):
+            f.write(b'\0' * (data_start + offset - f.tell()))
+            f.write(column.tobytes())
+
+
+class _SnapshotRecords(Mapping):
+    """
+    Read-only fingerprint -> record mapping over snapshot columns.
+    Records are built on first access and cached.
+    """
+
+    def __init__(self, columns, make_record):
+        self._columns = columns
+        self._make_record = make_record
+        self._rows = None
+        self._records = {}
+
+    def _row_index(self):
+        if self._rows is None:
+            self._rows = {fp.decode('ascii'): row for row, fp in
+                enumerate(self._columns['fingerprint'].tolist())}
+        return self._rows
+
+    def __getitem__(self, fprint):
+        record = self._records.get(fprint)
+        if record is None:
+            row = self._row_index()[fprint]
+            record = self._make_record(self._columns, row)
+            self._records[fprint] = record
+        return record
+
+    def __contains__(self, fprint):
+        return fprint in self._row_index()
+
+    def __iter__(self):
+        return iter(self._row_index())
+
+    def __len__(self):
+        return len(self._columns['fingerprint'])
+
+
+def _snapshot_relay(columns, row):
+    bandwidth = int(columns['bandwidth'][row])
+    return RelayRecord(columns['fingerprint'][row].decode('ascii'),
+        str(ipaddress.IPv4Address(int(columns['address'][row]))),
+        bitmask_to_flags(int(columns['flags'][row])),
+        None if bandwidth < 0 else bandwidth)
+
+
+def _snapshot_descriptor(columns, row):
+    return DescriptorRecord(columns['fingerprint'][row].decode('ascii'),
+        str(ipaddress.IPv4Address(int(columns['address'][row]))),
+        int(columns['average_bandwidth'][row]),
+        int(columns['observed_bandwidth'][row]))
+
+
+def load_network_state_snapshot(snapshot_filename):
+    """
+    Memory-maps a snapshot written by write_network_state_snapshot and
+    returns it as a NetworkState. The columns are read-only views of the
+    file, so processes loading the same snapshot share its pages.
+    cons_rel_stats and descriptors hold RelayRecord and DescriptorRecord.
+    hibernation is None for snapshots written without it.
+    """
+
+    with open(snapshot_filename, 'rb') as f:
+        if (f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC):
+            raise ValueError('{0} is not a network state snapshot'.format(
+                snapshot_filename))
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    if (header['flags'] != RELAY_FLAGS[:len(header['flags'])]):
+        raise ValueError('Snapshot flag bit order does not match RELAY_FLAGS')
+
+    data = np.memmap(snapshot_filename, dtype=np.uint8, mode='r')
+    data_start = _snapshot_align(len(SNAPSHOT_MAGIC) + 8 + header_len)
+    columns = {}
+    for name, dtype, offset, length in header['columns']:
+        start = data_start + offset
+        end = start + np.dtype(dtype).itemsize * length
+        columns[name] = data[start:end].view(dtype)
+
+    hibernation = None
+    if ('hibernation_time' in columns):
+        hibernation = HibernationTimeline(
+            columns['fingerprint'].astype('U40'), columns['hibernation_time'],
+            columns['hibernation_relay'], columns['hibernation_state'])
+
+    return NetworkState(_SnapshotRecords(columns, _snapshot_relay),
+        _SnapshotRecords(columns, _snapshot_descriptor),
+        header['valid_after'], header['fresh_until'], header['bw_weights'],
+        header['bwweightscale'], relay_columns=columns,
+        hibernation=hibernation, cons_bw_totals=header.get('bw_totals'))
+
+
+# (slope, intercept) of real bandwidth (B/s) on guard bandwidth weight, fit
+# by gen_regression_info.py on the 2018-08-01-07-00-00 consensus
+DEFAULT_BW_MODEL = (763.80, 2098271.21)
+
+class BandwidthModelTable:
+    """
+    Per-period (slope, intercept) models written by gen_regression_info.py
+    --ns_dir. Each model applies from the valid-after time of the first
+    consensus in its period until the next period starts.
+    """
+
+    def __init__(self, periods):
+        """
+        periods: list of dicts with period, start (UNIX timestamp), slope
+                 and intercept keys, sorted by start
+        """
+        self.periods = periods
+        self.starts = [period['start'] for period in periods]
+
+    def get_model(self, timestamp):
+        """
+        Returns (slope, intercept) for a consensus valid-after timestamp.
+        Times before the first period use the first model.
+        """
+
+        i = max(bisect.bisect_right(self.starts, timestamp) - 1, 0)
+        return (self.periods[i]['slope'], self.periods[i]['intercept'])
+
+def load_bw_model_table(filename):
+    """Loads BandwidthModelTable from json written by gen_regression_info.py."""
+
+    with open(filename, 'r') as f:
+        periods = json.load(f)
+    if not periods:
+        raise ValueError(f'No bandwidth models in {filename}')
+    return BandwidthModelTable(sorted(periods, key=lambda p: p['start']))
+
+def get_guard_bw_model(guard_to_bw, table_filename):
+    """
+    Returns (slope, intercept) model for the consensus the guard records in
+    guard_to_bw were taken from, from the BandwidthModelTable in
+    table_filename. Returns None, i.e. DEFAULT_BW_MODEL, if table_filename
+    does not exist or the records carry no valid-after time.
+    """
+
+    valid_afters = {getattr(guard, 'valid_after', None)
+        for guard in guard_to_bw}
+    if (len(valid_afters) > 1):
+        raise ValueError('Guard records are from more than one consensus')
+    valid_after = valid_afters.pop() if valid_afters else None
+    if (valid_after is None) or (not os.path.exists(table_filename)):
+        return None
+    return load_bw_model_table(table_filename).get_model(valid_after)
+
+def get_real_bw(bandwidth_weight, model=None):
     """
     Returns real bandwidth in Bytes/second given bandwidth weight 
-    (from linear regression).
+    (from linear regression). model is a (slope, intercept) pair, e.g.
+    from BandwidthModelTable.get_model, and defaults to DEFAULT_BW_MODEL.
     """
 
-    # from generate_real_bw_info.py
-    slope = 763.80
-    intercept = 2098271.21
+    if (model is None):
+        model = DEFAULT_BW_MODEL
+    slope, intercept = model
 
     return bandwidth_weight * slope + intercept
 
+# Empirical cost model (developed by Aaron Johnson) as sorted arrays. A relay
+# with bandwidth (Mbps) in (COST_BREAKPOINTS[i-1], COST_BREAKPOINTS[i]] costs
+# RELAY_COSTS[i] US dollars per month, with RELAY_COSTS[0] for bandwidths up to
+# the first breakpoint and RELAY_COSTS[-1] above the last one. From
+# GBPS_COST_THRESHOLD on, the cost is GBPS_COST per started Gbps.
+_COST_TABLE = [
+    (3.125, 0.608),
+    (3.3333333333333335, 0.6107142857142857),
+    (3.5714285714285716, 0.6138461538461538),
+    (3.8461538461538463, 0.6174999999999999),
+    (4.166666666666667, 0.6218181818181817),
+    (4.545454545454546, 0.627),
+    (5.0, 0.6333333333333333),
+    (5.555555555555555, 0.64125),
+    (6.25, 0.6514285714285714),
+    (7.142857142857143, 0.6649999999999999),
+    (8.333333333333334, 0.6839999999999999),
+    (10.0, 0.7124999999999999),
+    (12.5, 0.7599999999999999),
+    (16.666666666666668, 0.855),
+    (25.0, 1.1383333333333334),
+    (33.333333333333336, 1.14),
+    (50.0, 1.6466666666666667),
+    (55.55555555555556, 1.71),
+    (62.5, 1.7914285714285714),
+    (71.42857142857143, 1.8999999999999997),
+    (83.33333333333333, 2.052),
+    (100.0, 2.28),
+    (111.11111111111111, 2.2800000000000002),
+    (125.0, 2.605714285714286),
+    (142.85714285714286, 2.66),
+    (166.66666666666666, 3.192),
+    (200.0, 3.42),
+    (250.0, 4.56),
+    (333.3333333333333, 5.7),
+    (500.0, 11.4),
+]
+COST_BREAKPOINTS = [breakpoint for breakpoint, cost in _COST_TABLE]
+RELAY_COSTS = [0.605625] + [cost for breakpoint, cost in _COST_TABLE]
+GBPS_COST_THRESHOLD = 1000
+GBPS_COST = 11.4
+_COST_BREAKPOINTS_ARRAY = np.array(COST_BREAKPOINTS, dtype=np.float64)
+_RELAY_COSTS_ARRAY = np.array(RELAY_COSTS, dtype=np.float64)
+
 def relay_cost(bandwidth):
     """
     Empirical cost model (developed by Aaron Johnson).
     """
-    if (bandwidth >= 1000):
-        cost = 11.4 * math.ceil(bandwidth/1000)
-    elif (bandwidth > 500.0):
-        cost = 11.4
-    elif (bandwidth > 333.3333333333333):
-        cost = 5.7
-    elif (bandwidth > 250.0):
-        cost = 4.56
-    elif (bandwidth > 200.0):
-        cost = 3.42
-    elif (bandwidth > 166.66666666666666):
-        cost = 3.192
-    elif (bandwidth > 142.85714285714286):
-        cost = 2.66
-    elif (bandwidth > 125.0):
-        cost = 2.605714285714286
-    elif (bandwidth > 111.11111111111111):
-        cost = 2.2800000000000002
-    elif (bandwidth > 100.0):
-        cost = 2.28
-    elif (bandwidth > 83.33333333333333):
-        cost = 2.052
-    elif (bandwidth > 71.42857142857143):
-        cost = 1.8999999999999997
-    elif (bandwidth > 62.5):
-        cost = 1.7914285714285714
-    elif (bandwidth > 55.55555555555556):
-        cost = 1.71
-    elif (bandwidth > 50.0):
-        cost = 1.6466666666666667
-    elif (bandwidth > 33.333333333333336):
-        cost = 1.14
-    elif (bandwidth > 25.0):
-        cost = 1.1383333333333334
-    elif (bandwidth > 16.666666666666668):
-        cost = 0.855
-    elif (bandwidth > 12.5):
-        cost = 0.7599999999999999
-    elif (bandwidth > 10.0):
-        cost = 0.7124999999999999
-    elif (bandwidth > 8.333333333333334):
-        cost = 0.6839999999999999
-    elif (bandwidth > 7.142857142857143):
-        cost = 0.6649999999999999
-    elif (bandwidth > 6.25):
-        cost = 0.6514285714285714
-    elif (bandwidth > 5.555555555555555):
-        cost = 0.64125
-    elif (bandwidth > 5.0):
-        cost = 0.6333333333333333
-    elif (bandwidth > 4.545454545454546):
-        cost = 0.627
-    elif (bandwidth > 4.166666666666667):
-        cost = 0.6218181818181817
-    elif (bandwidth > 3.8461538461538463):
-        cost = 0.6174999999999999
-    elif (bandwidth > 3.5714285714285716):
-        cost = 0.6138461538461538
-    elif (bandwidth > 3.3333333333333335):
-        cost = 0.6107142857142857
-    elif (bandwidth > 3.125):
-        cost = 0.608
+    if (bandwidth >= GBPS_COST_THRESHOLD):
+        cost = GBPS_COST * math.ceil(bandwidth/1000)
     else:
-        cost = 0.605625
+        cost = RELAY_COSTS[bisect.bisect_left(COST_BREAKPOINTS, bandwidth)]
     return cost
 
-def get_cost(bandwidth_weight):
+def relay_cost_array(bandwidths):
+    """
+    Vectorized relay_cost: returns numpy array of monthly costs for an
+    array of bandwidths (Mbps).
+    """
+    bandwidths = np.asarray(bandwidths, dtype=np.float64)
+    # relay_cost puts NaN in the lowest bracket
+    idx = np.where(np.isnan(bandwidths), 0,
+        np.searchsorted(_COST_BREAKPOINTS_ARRAY, bandwidths, side='left'))
+    return np.where(bandwidths >= GBPS_COST_THRESHOLD,
+        GBPS_COST * np.ceil(bandwidths/1000), _RELAY_COSTS_ARRAY[idx])
+
+def get_cost(bandwidth_weight, model=None):
     """
     Returns monetary cost in US dollars of deploying a relay 
-    for 1 month given bandwidth weight.
+    for 1 month given bandwidth weight (see get_real_bw for model).
     """
 
-    real_bw_Bps = get_real_bw(bandwidth_weight)
+    real_bw_Bps = get_real_bw(bandwidth_weight, model)
     real_bw_Mbps = (real_bw_Bps * 8) / 1e6
-    return relay_cost(real_bw_Mbps)
\ No newline at end of file
+    return relay_cost(real_bw_Mbps)
+
+def get_cost_array(bandwidth_weights, model=None):
+    """
+    Vectorized get_cost: returns numpy array of monthly costs in US dollars
+    for an array of bandwidth weights. Matches get_cost exactly.
+    """
+
+    real_bw_Bps = get_real_bw(np.asarray(bandwidth_weights, dtype=np.float64),
+        model)
+    real_bw_Mbps = (real_bw_Bps * 8) / 1e6
+    return relay_cost_array(real_bw_Mbps)
+
+def get_cost_dict(guard_to_bw, model=None):
+    """
+    Returns a dict mapping each key of guard_to_bw (guard or fingerprint)
+    to the cost of its bandwidth weight, in the same order.
+    """
+
+    costs = get_cost_array(list(guard_to_bw.values()), model)
+    return dict(zip(guard_to_bw, costs.tolist()))
\ No newline at end of file